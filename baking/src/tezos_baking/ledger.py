@@ -0,0 +1,124 @@
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+"""
+Watching the Ledger devices, so that they're only enumerated with octez-client
+when something has changed
+"""
+
+import os
+import time
+import logging
+import threading
+
+# udev events are used when available, otherwise sysfs is polled
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+LEDGER_VENDOR_ID = 0x2C97
+
+HIDRAW_DIR = "/sys/class/hidraw"
+
+# Interval in seconds between two sysfs scans when udev events aren't available
+LEDGER_SCAN_INTERVAL = 0.5
+# Time in seconds given to a just connected device before it's enumerated
+LEDGER_SETTLE_DELAY = 0.5
+# Interval in seconds between the enumerations when nothing seems to change,
+# e.g. in case an app is opened without the device reconnecting
+LEDGER_RESCAN_INTERVAL = 15
+
+# Held around every octez-client call that talks to the Ledger devices.
+# octez-client finds a ledger by querying all the connected ones, so
+# the concurrent calls would interleave the APDU exchanges on the devices.
+ledger_lock = threading.Lock()
+
+
+# Returns the set of (hidraw device, HID id) pairs of the connected Ledger devices
+def ledger_hidraw_devices():
+    try:
+        names = os.listdir(HIDRAW_DIR)
+    except OSError:
+        return frozenset()
+    devices = set()
+    for name in names:
+        try:
+            with open(os.path.join(HIDRAW_DIR, name, "device", "uevent"), "r") as f:
+                uevent = dict(
+                    line.rstrip("\n").split("=", 1) for line in f if "=" in line
+                )
+        except OSError:
+            continue
+        # e.g. 'HID_ID=0003:00002C97:00001015', i.e. bus, vendor and product
+        hid_id = uevent.get("HID_ID", "")
+        fields = hid_id.split(":")
+        try:
+            if len(fields) == 3 and int(fields[1], 16) == LEDGER_VENDOR_ID:
+                devices.add((name, hid_id))
+        except ValueError:
+            continue
+    return frozenset(devices)
+
+
+class LedgerMonitor:
+    """
+    Waits for the Ledger devices to be connected, disconnected or to switch
+    between the apps, which makes them reconnect with another product id
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def open_udev_monitor(self):
+        if pyudev is None:
+            return None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by("hidraw")
+            monitor.start()
+            return monitor
+        except (OSError, ImportError) as e:
+            logging.info(f"Couldn't listen to udev events: {e}")
+            return None
+
+    # Waits up to `timeout` seconds for the set of the connected Ledger devices
+    # to differ from `devices` and returns the new set
+    def wait_for_change(self, monitor, devices, timeout):
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            if monitor is not None:
+                if monitor.poll(timeout=remaining) is None:
+                    break
+            else:
+                time.sleep(min(LEDGER_SCAN_INTERVAL, remaining))
+            current = ledger_hidraw_devices()
+            if current != devices:
+                return current
+        return devices
+
+    # Calls `probe` first and then every time the connected Ledger devices change,
+    # until it returns something other than None, which is then returned.
+    # Returns None if that doesn't happen in `timeout` seconds,
+    # `self.timeout` is used by default, None means waiting indefinitely.
+    def wait(self, probe, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        monitor = self.open_udev_monitor()
+        devices = ledger_hidraw_devices()
+        while (result := probe()) is None:
+            remaining = LEDGER_RESCAN_INTERVAL
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.monotonic())
+                if remaining <= 0:
+                    logging.info(f"No Ledger device was ready in {timeout}s")
+                    return None
+            current = self.wait_for_change(monitor, devices, remaining)
+            if current != devices:
+                logging.info(f"Connected Ledger devices changed: {sorted(current)}")
+                devices = current
+                time.sleep(LEDGER_SETTLE_DELAY)
+        return result
+
+
+ledger_monitor = LedgerMonitor()
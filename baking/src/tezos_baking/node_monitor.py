@@ -0,0 +1,467 @@
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+"""
+Watching the node service: waiting for it to become ready and to bootstrap,
+and watching the new blocks
+"""
+
+import os
+import json
+import time
+import random
+import socket
+import logging
+import calendar
+import threading
+import collections
+import urllib.parse
+
+from tezos_baking.util import *
+from tezos_baking.rpc import *
+
+# the unit state changes are received over D-Bus when available,
+# otherwise `systemctl show` is polled
+try:
+    import select
+    from pystemd.dbuslib import DBus
+    from pystemd.systemd1 import Manager, Unit
+except ImportError:
+    DBus = None
+
+# Readiness
+
+# Storage upgrade and identity generation can take a while on slow machines
+NODE_READY_TIMEOUT = 30 * 60
+
+# Bounds of the delay between two consecutive readiness checks
+READINESS_DELAY_MIN = 0.1
+READINESS_DELAY_MAX = 2.0
+
+
+class NodeNotReady(Exception):
+    "Raised when the node service has failed or hasn't become ready in time."
+
+
+# Yields exponentially growing delays between `initial` and `maximum`
+# seconds, with a random jitter of up to a half of the delay
+def backoff_delays(initial=READINESS_DELAY_MIN, maximum=READINESS_DELAY_MAX):
+    delay = initial
+    while True:
+        yield delay * (0.5 + random.random() / 2)
+        delay = min(delay * 2, maximum)
+
+
+# Returns the (ActiveState, SubState) pair of the systemd `unit`
+def get_unit_state(unit):
+    output = get_proc_output(
+        f"systemctl show --property=ActiveState,SubState {unit}"
+    ).stdout.decode()
+    properties = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+    return (properties.get("ActiveState"), properties.get("SubState"))
+
+
+class UnitStateMonitor:
+    """
+    Reads the state of the systemd `unit` over D-Bus and waits for its
+    PropertiesChanged signals, so that no process is spawned per check.
+    Falls back to `systemctl show` and sleeping when D-Bus can't be used.
+    """
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.bus = None
+        self.dbus_unit = None
+
+    def __enter__(self):
+        if DBus is None:
+            return self
+        try:
+            self.bus = DBus()
+            self.bus.open()
+            self.dbus_unit = Unit(self.unit.encode(), bus=self.bus, _autoload=True)
+            # systemd only emits the unit signals while somebody is subscribed
+            Manager(bus=self.bus, _autoload=True).Manager.Subscribe()
+            self.bus.match_signal(
+                self.dbus_unit.destination,
+                self.dbus_unit.path,
+                b"org.freedesktop.DBus.Properties",
+                b"PropertiesChanged",
+                lambda msg, error=None, userdata=None: None,
+                None,
+            )
+        except Exception as e:
+            logging.info(f"Couldn't watch {self.unit} over D-Bus: {e}")
+            self.close()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.bus is not None:
+            try:
+                self.bus.close()
+            except Exception:
+                pass
+        self.bus = None
+        self.dbus_unit = None
+
+    # Returns the (ActiveState, SubState) pair of the unit
+    def state(self):
+        if self.dbus_unit is not None:
+            try:
+                return (
+                    self.dbus_unit.Unit.ActiveState.decode(),
+                    self.dbus_unit.Unit.SubState.decode(),
+                )
+            except Exception as e:
+                logging.info(f"Lost the D-Bus connection: {e}, polling {self.unit}")
+                self.close()
+        return get_unit_state(self.unit)
+
+    # Waits up to `timeout` seconds, returning early if the unit's properties
+    # have changed in the meantime
+    def wait(self, timeout):
+        if self.bus is None:
+            time.sleep(timeout)
+            return
+        try:
+            readable, _, _ = select.select([self.bus.get_fd()], [], [], timeout)
+            if readable:
+                while self.bus.process():
+                    pass
+        except Exception as e:
+            logging.info(f"Lost the D-Bus connection: {e}, polling {self.unit}")
+            self.close()
+
+
+# Checks whether something listens on the RPC address, without
+# making an HTTP request
+def rpc_socket_open(rpc_endpoint):
+    address = urllib.parse.urlsplit(rpc_endpoint)
+    try:
+        default_port = 443 if address.scheme == "https" else 80
+        with socket.create_connection(
+            (address.hostname, address.port or default_port), timeout=1
+        ):
+            return True
+    except OSError:
+        return False
+
+
+def rpc_responds(rpc_endpoint):
+    return rpc_client(rpc_endpoint).is_reachable("/version", timeout=5)
+
+
+# Returns the current startup phase of the node service, one of
+# "stopped", "prestart", "identity", "starting", "rpc" and "ready".
+# Raises `NodeNotReady` if the service has failed.
+# `state` is the unit's (ActiveState, SubState) pair if it's already known.
+def get_node_phase(unit, rpc_endpoint, node_dir=None, state=None):
+    active, sub = get_unit_state(unit) if state is None else state
+    if active == "failed":
+        raise NodeNotReady(f"{unit} has failed")
+    if active == "inactive":
+        return "stopped"
+    if active == "activating" and sub == "start-pre":
+        # 'tezos-node-prestart' upgrades the storage and generates the identity
+        if node_dir is not None:
+            try:
+                os.stat(os.path.join(node_dir, "identity.json"))
+            except FileNotFoundError:
+                return "identity"
+            except OSError:
+                pass
+        return "prestart"
+    if active != "active":
+        return "starting"
+    if not rpc_socket_open(rpc_endpoint):
+        return "rpc"
+    return "ready" if rpc_responds(rpc_endpoint) else "rpc"
+
+
+# Time the just started service may take to leave the "stopped" phase
+NODE_START_GRACE = 10
+
+node_phase_messages = {
+    "prestart": "Preparing the node data directory...",
+    "identity": "Generating the node identity...",
+    "starting": "Starting the node...",
+    "rpc": "Waiting for the node RPC to come up...",
+    "ready": "The node is ready.",
+}
+
+
+# Waits until the node service `unit` serves the RPC at `rpc_endpoint`,
+# reporting every startup phase as soon as it's entered.
+# The unit state changes are received over D-Bus when possible, so the checks
+# don't spawn any process and are made as soon as the unit changes.
+# Otherwise, and for the RPC, the checks are made more and more rarely,
+# but never more than `READINESS_DELAY_MAX` apart.
+# Raises `NodeNotReady` if the service fails or `timeout` expires.
+def wait_for_node(unit, rpc_endpoint, node_dir=None, timeout=NODE_READY_TIMEOUT):
+    with UnitStateMonitor(unit) as monitor:
+        wait_for_node_phases(monitor, unit, rpc_endpoint, node_dir, timeout)
+
+
+def wait_for_node_phases(monitor, unit, rpc_endpoint, node_dir, timeout):
+    started = time.monotonic()
+    deadline = started + timeout
+    phase = None
+    running = False
+    delays = backoff_delays()
+    while True:
+        new_phase = get_node_phase(unit, rpc_endpoint, node_dir, monitor.state())
+        if new_phase != "stopped":
+            running = True
+        elif running or time.monotonic() - started > NODE_START_GRACE:
+            raise NodeNotReady(f"{unit} has stopped")
+        else:
+            # the start job may not have been picked up yet
+            new_phase = "starting"
+        if new_phase != phase:
+            logging.info(f"{unit}: {new_phase} after {time.monotonic() - started:.1f}s")
+            print(node_phase_messages[new_phase])
+            phase = new_phase
+            # the next phase is likely to come soon
+            delays = backoff_delays()
+        if phase == "ready":
+            return
+        now = time.monotonic()
+        if now >= deadline:
+            raise NodeNotReady(f"{unit} hasn't become ready in {timeout}s")
+        monitor.wait(min(next(delays), deadline - now))
+
+
+# Bootstrap progress
+
+# Interval in seconds between two progress reports
+BOOTSTRAP_REPORT_INTERVAL = 30
+# Time window in seconds over which the bootstrap speed is measured
+BOOTSTRAP_SPEED_WINDOW = 120
+# Time in seconds without any data after which a monitoring stream is reopened
+BOOTSTRAP_STREAM_TIMEOUT = 120
+
+
+def parse_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h{minutes:02}m"
+    return f"{minutes}m{seconds:02}s"
+
+
+# Returns the time between blocks of the current protocol in seconds,
+# or None if it can't be fetched
+def get_block_time(rpc_endpoint):
+    try:
+        constants = rpc_client(rpc_endpoint).get_static(
+            "/chains/main/blocks/head/context/constants"
+        )
+        return int(constants["minimal_block_delay"])
+    except (RpcError, ValueError, KeyError) as e:
+        logging.info(f"Couldn't get the block time: {e}")
+        return None
+
+
+class BootstrapProgress:
+    """Bootstrap progress estimated from the heads validated by the node"""
+
+    def __init__(self, block_time, window=BOOTSTRAP_SPEED_WINDOW):
+        self.block_time = block_time
+        self.window = window
+        # (monotonic time, level) of the recent heads
+        self.samples = collections.deque()
+        self.level = None
+        self.timestamp = None
+        self.lock = threading.Lock()
+
+    def add_head(self, level, timestamp, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.level = level
+            self.timestamp = timestamp
+            self.samples.append((now, level))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+                self.samples.popleft()
+
+    # Returns the current level, the target level estimated from how far the
+    # head is behind the wall clock, the speed in blocks per second and
+    # the estimated time left in seconds, or None before the first head.
+    # The chain keeps growing while the node catches up, so the ETA is based
+    # on the speed at which the node gains on the chain.
+    def report(self):
+        with self.lock:
+            if self.level is None:
+                return None
+            (first_time, first_level), (last_time, last_level) = (
+                self.samples[0],
+                self.samples[-1],
+            )
+            level, timestamp = self.level, self.timestamp
+        speed = (
+            (last_level - first_level) / (last_time - first_time)
+            if last_time > first_time
+            else None
+        )
+        target = None
+        eta = None
+        if self.block_time:
+            target = level + int(max(0, time.time() - timestamp) / self.block_time)
+            if speed is not None and speed > 1 / self.block_time:
+                eta = (target - level) / (speed - 1 / self.block_time)
+        return {
+            "level": level,
+            "target_level": target,
+            "head_timestamp": time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp)
+            ),
+            "blocks_per_second": None if speed is None else round(speed, 2),
+            "eta_seconds": None if eta is None else int(eta),
+        }
+
+
+def format_bootstrap_report(report):
+    message = f"Level {report['level']}"
+    if report["target_level"] is not None:
+        message += f" of ~{report['target_level']}"
+    message += f" (head at {report['head_timestamp']})"
+    if report["blocks_per_second"] is not None:
+        message += f", {report['blocks_per_second']:.1f} blocks/s"
+    if report["eta_seconds"] is not None:
+        message += f", ETA {format_duration(report['eta_seconds'])}"
+    return message
+
+
+# Keeps feeding `progress` with the heads streamed by the node until `done` is set
+def follow_heads(rpc, progress, done):
+    delays = backoff_delays()
+    while not done.is_set():
+        try:
+            for head in rpc.stream(
+                "/monitor/heads/main", timeout=BOOTSTRAP_STREAM_TIMEOUT
+            ):
+                progress.add_head(head["level"], parse_timestamp(head["timestamp"]))
+                delays = backoff_delays()
+                if done.is_set():
+                    return
+        except (RpcError, ValueError, KeyError) as e:
+            logging.info(f"Heads monitoring interrupted: {e}")
+        done.wait(next(delays))
+
+
+# Sets `done` once the node ends the '/monitor/bootstrapped' stream,
+# which it does as soon as it considers itself bootstrapped
+def follow_bootstrapped(rpc, done):
+    delays = backoff_delays()
+    while not done.is_set():
+        try:
+            for _ in rpc.stream(
+                "/monitor/bootstrapped", timeout=BOOTSTRAP_STREAM_TIMEOUT
+            ):
+                delays = backoff_delays()
+            done.set()
+            return
+        except RpcError as e:
+            logging.info(f"Bootstrap monitoring interrupted: {e}")
+        time.sleep(next(delays))
+
+
+# Waits until the node at `rpc_endpoint` is bootstrapped, reporting the level,
+# the target level, the speed and the ETA every `interval` seconds.
+# Every report is also logged as JSON, along with the `log_fields`, so that
+# the bootstrap speed can be compared across the hosts and snapshot sources.
+def wait_for_bootstrap(
+    rpc_endpoint, log_fields=None, interval=BOOTSTRAP_REPORT_INTERVAL
+):
+    rpc = rpc_client(rpc_endpoint)
+    progress = BootstrapProgress(get_block_time(rpc_endpoint))
+    done = threading.Event()
+    for target, args in [
+        (follow_heads, (rpc, progress, done)),
+        (follow_bootstrapped, (rpc, done)),
+    ]:
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    started = time.monotonic()
+    while not done.wait(interval):
+        report = progress.report()
+        if report is None:
+            continue
+        logging.info(
+            "Bootstrap progress: "
+            + json.dumps(
+                {
+                    **(log_fields or {}),
+                    **report,
+                    "elapsed_seconds": int(time.monotonic() - started),
+                }
+            )
+        )
+        print(format_bootstrap_report(report))
+    report = progress.report() or {}
+    logging.info(
+        "Bootstrap finished: "
+        + json.dumps(
+            {
+                **(log_fields or {}),
+                "level": report.get("level"),
+                "elapsed_seconds": int(time.monotonic() - started),
+            }
+        )
+    )
+
+
+# New blocks
+
+
+# Returns the balance of `address` in mutez as of the block `block`
+def get_balance(rpc_endpoint, address, block="head"):
+    try:
+        return int(
+            rpc_client(rpc_endpoint).get(
+                f"/chains/main/blocks/{block}/context/contracts/{address}/balance"
+            )
+        )
+    except RpcStatusError as e:
+        # the account hasn't been funded yet
+        if e.status == 404:
+            return 0
+        raise
+
+
+# Formats the `mutez` amount the way octez-client does, e.g. '6000.5 ꜩ'
+def format_tez(mutez):
+    tez, rest = divmod(mutez, 10**6)
+    return f"{tez}.{rest:06}".rstrip("0").rstrip(".") + " ꜩ"
+
+
+# Waits until the balance of `address` exceeds `minimum` mutez at a block
+# above `after_level` (if any) and returns the balance and the level of the block
+# it's been reached at.
+# The balance is checked once per block, as soon as the node streams it,
+# so no time is spent between the blocks.
+def wait_for_funds(rpc_endpoint, address, minimum=0, after_level=None):
+    rpc = rpc_client(rpc_endpoint)
+    delays = backoff_delays()
+    while True:
+        try:
+            # the current head comes first
+            for head in rpc.stream(
+                "/monitor/heads/main", timeout=BOOTSTRAP_STREAM_TIMEOUT
+            ):
+                balance = get_balance(rpc_endpoint, address, head["hash"])
+                logging.info(f"Balance of {address} at {head['level']}: {balance}")
+                if balance > minimum and (
+                    after_level is None or head["level"] > after_level
+                ):
+                    return (balance, head["level"])
+                delays = backoff_delays()
+        except (RpcError, ValueError, KeyError) as e:
+            logging.info(f"Heads monitoring interrupted: {e}")
+        time.sleep(next(delays))
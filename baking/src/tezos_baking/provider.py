@@ -2,16 +2,23 @@
 # SPDX-FileCopyrightText: 2024 Oxhead Alpha
 # SPDX-License-Identifier: LicenseRef-MIT-OA
 
+import os
 import re
 import json
+import time
+import socket
+import hashlib
+import logging
 import urllib.request
 
 from abc import abstractmethod
+from functools import lru_cache
 from dataclasses import dataclass
 
 from tezos_baking.util import *
 
 
+@lru_cache(maxsize=None)
 def get_node_version():
     version = get_proc_output("octez-node --version").stdout.decode("ascii")
     major_version, minor_version, rc_version = re.search(
@@ -25,12 +32,152 @@ def get_node_version():
     )
 
 
+def get_artifact_node_version(artifact):
+    version = artifact["tezos_version"]["version"]
+    # there seem to be some inconsistency with that field in different providers
+    # so the only thing we check is if it's a string
+    additional_info = version["additional_info"]
+    return (
+        version["major"],
+        version["minor"],
+        None if type(additional_info) == str else additional_info["rc"],
+    )
+
+
+SNAPSHOT_PREFERENCE_TIERS = ["exact version", "compatible older version", "compatible"]
+
+
+# Returns the index of the most preferred tier in `SNAPSHOT_PREFERENCE_TIERS`
+# the snapshot made by the Octez `version` belongs to, or None
+# if the snapshot can't be imported by the `node_version` node
+def snapshot_preference_tier(node_version, version, snapshot_version):
+    if version == node_version:
+        return 0
+    major_version, minor_version, rc_version = node_version
+    major, minor, rc = version
+    # rc snapshots are only used by the rc nodes
+    if rc_version is None and rc is not None:
+        return None
+    # it could happen that `snapshot_version` field is not supplied by provider
+    # e.g. marigold snapshots don't supply it
+    if not snapshot_version or compatible_snapshot_version - snapshot_version > 2:
+        return None
+    if major == major_version and (
+        (minor == minor_version and rc and rc_version and rc_version > rc)
+        or (minor < minor_version and rc is None)
+    ):
+        return 1
+    return 2
+
+
+# Timeout in seconds for every metadata request, so that a slow or dead
+# provider can't stall the wizard
+METADATA_TIMEOUT = 10
+
+
+# Directory for the cached metadata documents of the snapshot providers
+METADATA_CACHE_DIR = os.path.join(CACHE_DIR, "metadata/")
+# Time in seconds during which the cached metadata is used without revalidation
+METADATA_CACHE_TTL = 5 * 60
+# Time in seconds after the expiration during which the cached metadata is
+# still used in case the provider can't be reached
+METADATA_CACHE_STALE_IF_ERROR = 7 * 24 * 60 * 60
+
+
+class MetadataCache:
+    """On-disk cache of the JSON documents served by the snapshot providers"""
+
+    def __init__(self, directory, ttl, stale_if_error):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_if_error = stale_if_error
+
+    def path(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode()).hexdigest() + ".json"
+        )
+
+    def load(self, url):
+        try:
+            ensure_private_dir(self.directory)
+            with open(self.path(url), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def save(self, url, entry):
+        filename = self.path(url)
+        try:
+            ensure_private_dir(self.directory)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logging.warning(f"Couldn't cache the metadata from {url}: {e}")
+
+    # Returns the JSON document served at `url`. Fresh cached documents are used
+    # as is, expired ones are revalidated with a conditional request, and when
+    # the provider can't be reached, the cached document is used for
+    # `stale_if_error` more seconds after its expiration
+    def get_json(self, url, timeout=METADATA_TIMEOUT):
+        entry = self.load(url)
+        now = time.time()
+        if entry is not None and now - entry["fetched"] < self.ttl:
+            logging.info(f"Using the cached metadata from {url}")
+            return entry["body"]
+
+        headers = dict(http_request_headers)
+        if entry is not None and entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                entry = {
+                    "url": url,
+                    "fetched": now,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "body": json.load(response),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or entry is None:
+                return self.stale_or_raise(url, entry, now, e)
+            logging.info(f"The cached metadata from {url} is still up to date")
+            entry["fetched"] = now
+        except (urllib.error.URLError, socket.timeout, ValueError) as e:
+            return self.stale_or_raise(url, entry, now, e)
+        self.save(url, entry)
+        return entry["body"]
+
+    def stale_or_raise(self, url, entry, now, error):
+        if entry is None or now - entry["fetched"] >= self.ttl + self.stale_if_error:
+            raise error
+        logging.warning(
+            f"Couldn't fetch the metadata from {url}: {error}, "
+            "using the cached metadata instead"
+        )
+        return entry["body"]
+
+
+metadata_cache = MetadataCache(
+    METADATA_CACHE_DIR, METADATA_CACHE_TTL, METADATA_CACHE_STALE_IF_ERROR
+)
+
+
 @dataclass
 class Provider:
     title: str
 
+    def fetch_metadata(self, url, timeout=METADATA_TIMEOUT):
+        return metadata_cache.get_json(url, timeout)
+
     @abstractmethod
-    def get_snapshot_metadata(self, network, history_mode, region=None):
+    def get_snapshot_metadata(
+        self, network, history_mode, region=None, timeout=METADATA_TIMEOUT
+    ):
         pass
 
 
@@ -44,161 +191,109 @@ class Marigold(Provider):
     # * if there is none, try to find the snapshot with the same major version, but less minor version
     #   and with the `snapshot_version` compatible with the user's Octez version.
     # * If there is none, try to find the snapshot with any Octez version, but compatible `snapshot_version`.
+    # Among the snapshots of the most preferred step the one with the highest block is chosen.
+    # This is done in a single pass over the snapshots, each of them is ranked once.
     def extract_relevant_snapshot(self, snapshot_array, network, history_mode):
-        from functools import reduce
-
-        def find_snapshot(pred):
-            return next(
-                filter(
-                    lambda artifact: artifact["artifact_type"] == "tezos-snapshot"
-                    and artifact["chain_name"] == network
-                    and (
-                        artifact["history_mode"] == history_mode
-                        or (
-                            history_mode == "archive"
-                            and artifact["history_mode"] == "full"
-                        )
-                    )
-                    and pred(
-                        *(
-                            get_artifact_node_version(artifact)
-                            + (artifact.get("snapshot_version", None),)
-                        )
-                    ),
-                    iter(snapshot_array),
-                ),
-                None,
-            )
-
-        def get_artifact_node_version(artifact):
-            version = artifact["tezos_version"]["version"]
-            # there seem to be some inconsistency with that field in different providers
-            # so the only thing we check is if it's a string
-            additional_info = version["additional_info"]
-            return (
-                version["major"],
-                version["minor"],
-                None if type(additional_info) == str else additional_info["rc"],
-            )
-
-        def compose_pred(*preds):
-            return reduce(
-                lambda acc, x: lambda major, minor, rc, snapshot_version: acc(
-                    major, minor, rc, snapshot_version
-                )
-                and x(major, minor, rc, snapshot_version),
-                preds,
-            )
-
-        def sum_pred(*preds):
-            return reduce(
-                lambda acc, x: lambda major, minor, rc, snapshot_version: acc(
-                    major, minor, rc, snapshot_version
-                )
-                or x(major, minor, rc, snapshot_version),
-                preds,
-            )
-
-        node_version = get_node_version()
-        major_version, minor_version, rc_version = node_version
-
-        exact_version_pred = (
-            lambda major, minor, rc, snapshot_version: node_version
-            == (
-                major,
-                minor,
-                rc,
-            )
-        )
-
-        exact_major_version_pred = (
-            lambda major, minor, rc, snapshot_version: major_version == major
+        history_modes = (
+            {"archive", "full"} if history_mode == "archive" else {history_mode}
         )
+        node_version = get_node_version()
 
-        exact_minor_version_pred = (
-            lambda major, minor, rc, snapshot_version: minor_version == minor
-        )
+        # best snapshot found for every preference tier
+        best = [None] * len(SNAPSHOT_PREFERENCE_TIERS)
+        for artifact in snapshot_array:
+            if (
+                artifact["artifact_type"] != "tezos-snapshot"
+                or artifact["chain_name"] != network
+                or artifact["history_mode"] not in history_modes
+            ):
+                continue
+            tier = snapshot_preference_tier(
+                node_version,
+                get_artifact_node_version(artifact),
+                artifact.get("snapshot_version", None),
+            )
+            if tier is None:
+                continue
+            if (
+                best[tier] is None
+                or artifact["block_height"] > best[tier]["block_height"]
+            ):
+                best[tier] = artifact
+
+        return next((snapshot for snapshot in best if snapshot is not None), None)
+
+    def get_snapshot_metadata(
+        self, network, history_mode, region=None, timeout=METADATA_TIMEOUT
+    ):
+        snapshot_array = self.fetch_metadata(self.metadata_url, timeout)["data"]
+        return self.extract_relevant_snapshot(snapshot_array, network, history_mode)
 
-        less_minor_version_pred = (
-            lambda major, minor, rc, snapshot_version: minor_version > minor
-        )
 
-        exact_rc_version_pred = (
-            lambda major, minor, rc, snapshot_version: rc_version == rc
-        )
-
-        less_rc_version_pred = (
-            lambda major, minor, rc, snapshot_version: rc
-            and rc_version
-            and rc_version > rc
-        )
+class TzInit(Provider):
+    regions = ["eu", "us", "asia"]
 
-        non_rc_version_pred = lambda major, minor, rc, snapshot_version: rc is None
+    # Size of the snapshot sample that is downloaded from every regional mirror
+    # in order to estimate the throughput
+    probe_sample_size = 2 * 1024 * 1024
 
-        compatible_version_pred = (
-            # it could happen that `snapshot_version` field is not supplied by provider
-            # e.g. marigold snapshots don't supply it
-            lambda major, minor, rc, snapshot_version: snapshot_version
-            and compatible_snapshot_version - snapshot_version <= 2
+    # Measures the time to the first byte and the throughput of the small ranged
+    # request of the snapshot from the `region` mirror
+    def probe_region(self, region, network, history_mode, timeout=METADATA_TIMEOUT):
+        url = f"https://snapshots.{region}.tzinit.org/{network}/{history_mode}"
+        request = urllib.request.Request(
+            url,
+            headers={
+                **http_request_headers,
+                "Range": f"bytes=0-{self.probe_sample_size - 1}",
+            },
         )
-
-        non_rc_on_stable_pred = lambda major, minor, rc, snapshot_version: (
-            rc_version is None and rc is None
-        ) or (rc_version is not None)
-
-        preds = [
-            exact_version_pred,
-            compose_pred(
-                non_rc_on_stable_pred,
-                compatible_version_pred,
-                sum_pred(
-                    compose_pred(
-                        exact_major_version_pred,
-                        exact_minor_version_pred,
-                        less_rc_version_pred,
-                    ),
-                    compose_pred(
-                        exact_major_version_pred,
-                        less_minor_version_pred,
-                        non_rc_version_pred,
-                    ),
-                ),
-            ),
-            compose_pred(
-                non_rc_on_stable_pred,
-                compatible_version_pred,
-            ),
-        ]
-
-        return next(
-            (
-                snapshot
-                for snapshot in map(
-                    lambda pred: find_snapshot(pred),
-                    preds,
+        started = time.monotonic()
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            first_byte = response.read(1)
+            rtt = time.monotonic() - started
+            nbytes = len(first_byte) + len(response.read(self.probe_sample_size))
+        transfer_time = time.monotonic() - started - rtt
+        throughput = nbytes / transfer_time if transfer_time > 0 else float("inf")
+        return (rtt, throughput)
+
+    # Probes every regional mirror one after another, so that the measurements
+    # don't compete for the bandwidth, and returns the one with the best
+    # throughput, the lowest latency breaking the ties
+    def select_region(self, network, history_mode, timeout=METADATA_TIMEOUT):
+        measurements = {}
+        for region in self.regions:
+            try:
+                measurements[region] = self.probe_region(
+                    region, network, history_mode, timeout
                 )
-                if snapshot is not None
-            ),
-            None,
+            except (urllib.error.URLError, OSError) as e:
+                logging.info(f"tzinit {region} mirror is unavailable: {e}")
+                continue
+            rtt, throughput = measurements[region]
+            logging.info(
+                f"tzinit {region} mirror: time to first byte {rtt * 1000:.0f}ms, "
+                f"throughput {throughput / (1024 * 1024):.2f} MB/s"
+            )
+        if not measurements:
+            logging.info("No tzinit mirror could be probed, defaulting to eu")
+            return "eu"
+        region = max(
+            measurements, key=lambda r: (measurements[r][1], -measurements[r][0])
         )
+        logging.info(f"Selected the tzinit {region} mirror")
+        return region
 
-    def get_snapshot_metadata(self, network, history_mode, region=None):
-        snapshot_array = None
-        with urllib.request.urlopen(self.metadata_url) as url:
-            snapshot_array = json.load(url)["data"]
-        snapshot_array.sort(reverse=True, key=lambda x: x["block_height"])
-        return self.extract_relevant_snapshot(snapshot_array, network, history_mode)
-
-
-class TzInit(Provider):
-    def get_filesize(self, url):
+    def get_filesize(self, url, timeout=METADATA_TIMEOUT):
         request = urllib.request.Request(
             url, headers=http_request_headers, method="HEAD"
         )
         content_length = next(
             (
                 header[1]
-                for header in urllib.request.urlopen(request).info()._headers
+                for header in urllib.request.urlopen(request, timeout=timeout)
+                .info()
+                ._headers
                 if header[0] == "Content-Length"
             ),
             None,
@@ -214,12 +309,17 @@ class TzInit(Provider):
             return "%s%s" % (f, suffixes[i])
         return content_length
 
-    def get_snapshot_metadata(self, network, history_mode, region=None):
+    def get_snapshot_metadata(
+        self, network, history_mode, region=None, timeout=METADATA_TIMEOUT
+    ):
         region = "eu" if region is None else region
         history_mode = "full" if history_mode == "archive" else history_mode
+        if region == "auto":
+            region = self.select_region(network, history_mode, timeout)
         self.metadata_url = f"https://snapshots.{region}.tzinit.org/{network}/{history_mode}.json"
-        with urllib.request.urlopen(self.metadata_url) as url:
-            snapshot_metadata = json.load(url)["snapshot_header"]
+        snapshot_metadata = self.fetch_metadata(self.metadata_url, timeout)[
+            "snapshot_header"
+        ]
 
         snapshot_metadata["block_height"] = snapshot_metadata["level"]
         snapshot_metadata[
@@ -228,10 +328,12 @@ class TzInit(Provider):
         snapshot_metadata["sha256"] = None
         snapshot_metadata["filesize"] = (
             "not provided"
-            if (filesize := self.get_filesize(snapshot_metadata["url"])) is None
+            if (filesize := self.get_filesize(snapshot_metadata["url"], timeout))
+            is None
             else filesize
         )
         snapshot_metadata["block_timestamp"] = snapshot_metadata["timestamp"]
+        snapshot_metadata["region"] = region
 
         return snapshot_metadata
 
@@ -0,0 +1,352 @@
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+"""
+Client for the Tezos node RPC that keeps its connections alive between the calls
+"""
+
+import os
+import json
+import codecs
+import time
+import hashlib
+import random
+import logging
+import threading
+import http.client
+import urllib.parse
+
+from tezos_baking.util import *
+
+# Timeout in seconds for connecting to the node and for every read from it
+RPC_TIMEOUT = 10
+
+# Number of times a failed idempotent call is retried
+RPC_RETRIES = 2
+
+# Number of idle connections kept open for every endpoint
+RPC_POOL_SIZE = 4
+
+# Directory for the cached RPC results that only change with the protocol
+RPC_CACHE_DIR = os.path.join(CACHE_DIR, "rpc/")
+# Time in seconds during which the protocol of the head is assumed unchanged
+PROTOCOL_CHECK_INTERVAL = 60
+
+
+class RpcError(Exception):
+    "Raised when an RPC call fails."
+
+
+class RpcUnavailable(RpcError):
+    "Raised when the node can't be reached."
+
+    def __init__(self, url, reason):
+        self.url = url
+        self.reason = reason
+        super().__init__(f"{url} is unavailable: {reason}")
+
+
+class RpcStatusError(RpcError):
+    "Raised when the node responds to an RPC call with an error status."
+
+    def __init__(self, url, status, body):
+        self.url = url
+        self.status = status
+        self.body = body
+        super().__init__(f"{url} responded with {status}: {body[:200]!r}")
+
+
+class RpcClient:
+    """
+    Client of a single RPC endpoint, e.g. 'http://localhost:8732'.
+    Connections are reused across the calls, idle ones are kept in a small pool,
+    so that the concurrent callers don't share a connection.
+    GET calls that fail to connect or time out are retried with a backoff,
+    a call on a pooled connection the server has closed in the meantime
+    is transparently repeated on a new one.
+    """
+
+    def __init__(
+        self,
+        endpoint,
+        timeout=RPC_TIMEOUT,
+        retries=RPC_RETRIES,
+        pool_size=RPC_POOL_SIZE,
+    ):
+        address = urllib.parse.urlsplit(endpoint)
+        if address.scheme not in ["http", "https"] or not address.hostname:
+            raise ValueError(f"Invalid RPC endpoint: {endpoint}")
+        self.origin = f"{address.scheme}://{address.netloc}"
+        self.https = address.scheme == "https"
+        self.host = address.hostname
+        self.port = address.port
+        self.prefix = address.path.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.pool = []
+        self.lock = threading.Lock()
+        self.chain_id = None
+        self.protocol = None
+        self.protocol_checked = None
+
+    def acquire(self, timeout):
+        with self.lock:
+            if self.pool:
+                connection = self.pool.pop()
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                connection.timeout = timeout
+                return (connection, True)
+        connection_class = (
+            http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        )
+        return (connection_class(self.host, self.port, timeout=timeout), False)
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.pool) < self.pool_size:
+                self.pool.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            pool, self.pool = self.pool, []
+        for connection in pool:
+            connection.close()
+
+    # Performs the RPC call and returns the raw response body.
+    # Raises `RpcStatusError` on the error statuses and `RpcUnavailable` when the node
+    # can't be reached after all the retries (non-GET calls aren't retried).
+    def request(self, method, path, body=None, timeout=None, retries=None):
+        timeout = self.timeout if timeout is None else timeout
+        retries = (
+            (self.retries if retries is None else retries) if method == "GET" else 0
+        )
+        path = self.prefix + "/" + path.lstrip("/")
+        url = self.origin + path
+        headers = {**http_request_headers, "Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+
+        attempt = 0
+        while True:
+            connection, reused = self.acquire(timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                # the server may have closed the idle connection, that's not a failure
+                if reused and isinstance(
+                    e,
+                    (
+                        http.client.RemoteDisconnected,
+                        ConnectionResetError,
+                        BrokenPipeError,
+                    ),
+                ):
+                    continue
+                attempt += 1
+                if attempt > retries:
+                    raise RpcUnavailable(url, e)
+                delay = 0.2 * 2**attempt * (0.5 + random.random() / 2)
+                logging.info(f"RPC call {url} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(connection)
+            if response.status >= 400:
+                raise RpcStatusError(url, response.status, data)
+            return data
+
+    def get(self, path, **kwargs):
+        return json.loads(self.request("GET", path, **kwargs))
+
+    def post(self, path, data, **kwargs):
+        return json.loads(self.request("POST", path, json.dumps(data), **kwargs))
+
+    # Yields the body of the RPC response at `path` piece by piece, as it's received,
+    # so that the caller can stop reading as soon as it's seen enough.
+    # The response holds its own connection, so it doesn't deplete the pool.
+    # Raises `RpcUnavailable` if nothing is received for `timeout` seconds.
+    def stream_bytes(self, path, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        path = self.prefix + "/" + path.lstrip("/")
+        url = self.origin + path
+        connection_class = (
+            http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        )
+        connection = connection_class(self.host, self.port, timeout=timeout)
+        try:
+            try:
+                connection.request(
+                    "GET",
+                    path,
+                    headers={**http_request_headers, "Accept": "application/json"},
+                )
+                response = connection.getresponse()
+                if response.status >= 400:
+                    raise RpcStatusError(url, response.status, response.read())
+                while chunk := response.read1(64 * 1024):
+                    yield chunk
+            except (http.client.HTTPException, OSError) as e:
+                raise RpcUnavailable(url, e)
+        finally:
+            connection.close()
+
+    # Yields the JSON values of the streaming RPC at `path`, e.g. '/monitor/heads/main',
+    # as soon as the node sends them, until the node ends the stream
+    def stream(self, path, timeout=None):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        for chunk in self.stream_bytes(path, timeout):
+            buffer += utf8.decode(chunk)
+            while buffer := buffer.lstrip():
+                try:
+                    value, end = decoder.raw_decode(buffer)
+                except ValueError:
+                    # the value is split between the chunks
+                    break
+                buffer = buffer[end:]
+                yield value
+
+    # Returns the chain id and the protocol of the blocks after the head,
+    # the latter is refetched at most every `PROTOCOL_CHECK_INTERVAL` seconds
+    def get_protocol_scope(self):
+        now = time.monotonic()
+        if self.chain_id is None:
+            self.chain_id = self.get("/chains/main/chain_id")
+        if (
+            self.protocol_checked is None
+            or now - self.protocol_checked >= PROTOCOL_CHECK_INTERVAL
+        ):
+            self.protocol = self.get("/chains/main/blocks/head/protocols")[
+                "next_protocol"
+            ]
+            self.protocol_checked = now
+        return (self.chain_id, self.protocol)
+
+    # Same as `get`, for the RPCs whose results only change with the protocol,
+    # e.g. '/chains/main/blocks/head/context/constants'
+    def get_static(self, path):
+        return protocol_cache.get(self, path)
+
+    # Checks whether `path` can be fetched from the node
+    def is_reachable(self, path="/version", timeout=None):
+        try:
+            self.request("GET", path, timeout=timeout, retries=0)
+            return True
+        except RpcError:
+            return False
+
+
+class ProtocolCache:
+    """
+    Cache of the RPC results that only change with the protocol, kept both in
+    memory and on disk, so that they're shared by the wizard runs.
+    The results are keyed by the chain id and the protocol hash, so they're
+    invalidated as soon as the protocol changes.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(
+            self.directory,
+            hashlib.sha256(json.dumps(key).encode()).hexdigest() + ".json",
+        )
+
+    def load(self, key):
+        try:
+            ensure_private_dir(self.directory)
+            with open(self.path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("key") == key else None
+
+    def save(self, key, entry):
+        filename = self.path(key)
+        try:
+            ensure_private_dir(self.directory)
+            with open(filename + ".tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(filename + ".tmp", filename)
+        except OSError as e:
+            logging.warning(f"Couldn't cache the result of {key[-1]}: {e}")
+
+    def get(self, client, path):
+        chain_id, protocol = client.get_protocol_scope()
+        key = [chain_id, protocol, path]
+        with self.lock:
+            entry = self.entries.get(tuple(key))
+        if entry is None:
+            entry = self.load(key)
+            if entry is None:
+                entry = {"key": key, "body": client.get(path)}
+                self.save(key, entry)
+            else:
+                logging.info(f"Using the cached result of {path} for {protocol}")
+            with self.lock:
+                self.entries[tuple(key)] = entry
+        return entry["body"]
+
+
+protocol_cache = ProtocolCache(RPC_CACHE_DIR)
+
+
+# Checks whether the `key` list of the JSON object, whose body is read from `chunks`,
+# contains the string `value`, without parsing or keeping the whole object,
+# and stops reading as soon as the answer is known.
+# Only suitable for the lists of plain strings, e.g. contract addresses.
+def json_list_contains(chunks, key, value):
+    key_token = json.dumps(key).encode()
+    value_token = json.dumps(value).encode()
+    buffer = b""
+    in_list = False
+    for chunk in chunks:
+        buffer += chunk
+        if not in_list:
+            start = buffer.find(key_token)
+            if start < 0:
+                # the key may be split between the chunks
+                buffer = buffer[-len(key_token) :]
+                continue
+            bracket = buffer.find(b"[", start + len(key_token))
+            if bracket < 0:
+                buffer = buffer[start:]
+                continue
+            in_list = True
+            buffer = buffer[bracket + 1 :]
+        found = buffer.find(value_token)
+        end = buffer.find(b"]")
+        if found >= 0 and (end < 0 or found < end):
+            return True
+        if end >= 0:
+            return False
+        buffer = buffer[-len(value_token) :]
+    return False
+
+
+rpc_clients = {}
+rpc_clients_lock = threading.Lock()
+
+
+# Returns the client of the given RPC endpoint, shared by all the callers
+def rpc_client(endpoint):
+    endpoint = endpoint.rstrip("/")
+    with rpc_clients_lock:
+        client = rpc_clients.get(endpoint)
+        if client is None:
+            client = RpcClient(endpoint)
+            rpc_clients[endpoint] = client
+        return client
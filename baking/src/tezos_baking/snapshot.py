@@ -0,0 +1,1205 @@
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+"""
+Snapshot handling utilities: hashing, downloading and placing snapshot files
+"""
+
+import os
+import re
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import fcntl
+import random
+import contextlib
+import threading
+import hashlib
+import logging
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tezos_baking.util import *
+
+# Hashing
+
+# Size of the buffer that is fed to the digest at once. Big enough to amortize
+# the per-call overhead, small enough to keep the wizard's memory usage flat
+# regardless of the snapshot size.
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+# Accepts either the name of a hashlib algorithm or a digest constructor
+# (e.g. `hashlib.sha256`) and returns a fresh digest object
+def new_digest(digest="sha256"):
+    if callable(digest):
+        return digest()
+    return hashlib.new(digest)
+
+
+class HashStats:
+    "Amount of data hashed and the time it took."
+
+    def __init__(self, nbytes=0, seconds=0.0):
+        self.nbytes = nbytes
+        self.seconds = seconds
+
+    def throughput(self):
+        return self.nbytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"hashed {self.nbytes // 1024**2} MB in {self.seconds:.1f}s "
+            f"({self.throughput() / 1024**2:.1f} MB/s)"
+        )
+
+
+class TimedDigest:
+    """
+    Digest that keeps the `HashStats` of the data it's fed with,
+    so that the hashing throughput of a download can be reported
+    """
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+        self.name = hasher.name
+        self.stats = HashStats()
+
+    def update(self, data):
+        start = time.monotonic()
+        self.hasher.update(data)
+        self.stats.seconds += time.monotonic() - start
+        self.stats.nbytes += len(data)
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+# Feeds `length` bytes (or everything up to the end of file) of `filename` starting
+# from `offset` into `hasher` chunk by chunk, reusing a single buffer, so that
+# the memory used doesn't depend on the file size.
+def update_digest_from_file(
+    hasher, filename, length=None, offset=0, chunk_size=HASH_CHUNK_SIZE
+):
+    with open(filename, "rb") as f:
+        size = max(os.fstat(f.fileno()).st_size - offset, 0)
+        remaining = size if length is None else min(length, size)
+        f.seek(offset)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while remaining > 0:
+            nread = f.readinto(view[: min(chunk_size, remaining)])
+            if not nread:
+                break
+            hasher.update(view[:nread])
+            remaining -= nread
+
+
+# Throttling
+
+RATE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+# Parses a rate like '500K' or '10M' into bytes per second,
+# '0' and 'unlimited' mean no limit and are parsed into None.
+# Rates below 1 byte per second are rejected rather than rounded to no limit.
+def parse_rate(rate):
+    normalized = rate.strip().upper()
+    if normalized in ["0", "UNLIMITED"]:
+        return None
+    match = re.fullmatch(r"([0-9]+(?:\.[0-9]+)?) *([KMG]?)I?B?(?:/S)?", normalized)
+    if match is None:
+        raise ValueError(f"Invalid rate: {rate.strip()}")
+    value = float(match.group(1)) * RATE_SUFFIXES[match.group(2)]
+    if value == 0:
+        return None
+    if value < 1:
+        raise ValueError(f"Rate is below 1 byte per second: {rate.strip()}")
+    return int(value)
+
+
+def format_rate(rate):
+    return "unlimited" if rate is None else f"{rate / 1024**2:.2f}M"
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the connections of a download. The bucket can go
+    into debt, so that a whole chunk can always be acquired, and callers wait
+    until the debt is repaid at `rate` bytes per second.
+    If `control_file` is given, the rate is reloaded from it whenever
+    it's modified, so that the limit can be changed while the download runs.
+    """
+
+    def __init__(self, rate=None, control_file=None):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.control_file = control_file
+        self.control_mtime = None
+        if control_file is not None:
+            with open(control_file, "w") as f:
+                f.write(format_rate(rate) + "\n")
+            self.control_mtime = os.stat(control_file).st_mtime
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            logging.info(f"Download rate limit is set to {format_rate(rate)}")
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            # at most one second worth of tokens is accumulated
+            self.tokens = min(
+                self.tokens + (now - self.updated) * self.rate,
+                max(self.rate, DOWNLOAD_CHUNK_SIZE),
+            )
+        else:
+            self.tokens = 0.0
+        self.updated = now
+
+    def reload(self):
+        if self.control_file is None:
+            return
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+            if mtime == self.control_mtime:
+                return
+            self.control_mtime = mtime
+            with open(self.control_file, "r") as f:
+                rate = parse_rate(f.read())
+        except (OSError, ValueError) as e:
+            logging.warning(f"Couldn't reload the download rate limit: {e}")
+            return
+        self.set_rate(rate)
+
+    # Takes `nbytes` tokens from the bucket, waiting until the bucket
+    # isn't in debt anymore
+    def acquire(self, nbytes):
+        with self.lock:
+            self.refill()
+            self.tokens -= nbytes
+        while True:
+            self.reload()
+            with self.lock:
+                self.refill()
+                if not self.rate or self.tokens >= 0:
+                    return
+                delay = -self.tokens / self.rate
+            # wake up periodically to pick up the rate changes
+            time.sleep(min(delay, 0.5))
+
+
+# Niceness and IO scheduling class of the background downloads and imports
+BACKGROUND_NICENESS = 10
+BACKGROUND_IONICE_CLASS = 3  # idle
+
+# Command prefix that runs a command with the background priority
+background_priority_prefix = (
+    f"nice -n {BACKGROUND_NICENESS} ionice -c {BACKGROUND_IONICE_CLASS} "
+)
+
+
+# Lowers the CPU and IO priority of the calling thread, on Linux both are
+# per thread, so the rest of the wizard isn't affected
+def lower_thread_priority():
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(
+            os.PRIO_PROCESS,
+            tid,
+            max(os.getpriority(os.PRIO_PROCESS, tid), BACKGROUND_NICENESS),
+        )
+        subprocess.run(
+            ["ionice", "-c", str(BACKGROUND_IONICE_CLASS), "-p", str(tid)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning(f"Couldn't lower the download priority: {e}")
+
+
+# Runs `f(*args)` in a separate thread with the lowered priority and returns
+# its result. The thread is a daemon, so that an interrupted wizard
+# doesn't wait for it.
+def run_in_background(f, *args):
+    result = {}
+
+    def target():
+        lower_thread_priority()
+        try:
+            result["value"] = f(*args)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    while thread.is_alive():
+        thread.join(0.5)
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+# Disk space
+
+# Rough ratio of the node data size right after the import to the snapshot size
+IMPORT_EXPANSION = {"rolling": 2.0, "full": 2.5, "archive": 10.0}
+
+
+class InsufficientSpace(Exception):
+    "Raised when a filesystem doesn't have enough free space for the snapshot."
+
+    def __init__(self, path, required, available):
+        self.path = path
+        self.required = required
+        self.available = available
+        super().__init__(
+            f"Not enough free space for {path}: {required / 1024**3:.1f} GiB "
+            f"is required, but only {available / 1024**3:.1f} GiB is available"
+        )
+
+
+# Returns the device and the free space of the filesystem `path` is
+# (or will be) on, looking at the closest existing parent directory
+def filesystem_free_space(path):
+    path = os.path.abspath(path)
+    while True:
+        try:
+            st = os.statvfs(path)
+            return (os.stat(path).st_dev, st.f_bavail * st.f_frsize)
+        except (FileNotFoundError, PermissionError):
+            if path == os.path.dirname(path):
+                raise
+            path = os.path.dirname(path)
+
+
+# Checks that every filesystem has enough free space for the given
+# {path: required bytes} `requirements`, paths on the same filesystem
+# share its free space.
+# Raises `InsufficientSpace` otherwise.
+def check_free_space(requirements):
+    filesystems = {}
+    for path, required in requirements.items():
+        device, available = filesystem_free_space(path)
+        paths, total, _ = filesystems.get(device, ([], 0, available))
+        filesystems[device] = (paths + [path], total + required, available)
+    for paths, required, available in filesystems.values():
+        logging.info(
+            f"{', '.join(paths)}: {required} bytes required, {available} available"
+        )
+        if required > available:
+            raise InsufficientSpace(" and ".join(paths), required, available)
+
+
+# `fallocate(2)` is called directly: unlike it, glibc's `posix_fallocate` emulates
+# the preallocation on the filesystems that don't support it by writing every
+# block, which would mean an extra write pass over the whole snapshot
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc_fallocate = libc.fallocate64
+    libc_fallocate.argtypes = [
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int64,
+        ctypes.c_int64,
+    ]
+except (OSError, AttributeError):
+    libc_fallocate = None
+
+
+# Reserves `size` bytes for the file, so that it's laid out contiguously and
+# running out of space is detected upfront rather than late in the download.
+# Falls back to just setting the file size on the filesystems that
+# don't support the preallocation natively.
+def preallocate(fd, size):
+    if libc_fallocate is not None and libc_fallocate(fd, 0, 0, size) == 0:
+        return
+    error = errno.EOPNOTSUPP if libc_fallocate is None else ctypes.get_errno()
+    if error not in [errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS]:
+        raise OSError(error, os.strerror(error))
+    os.ftruncate(fd, size)
+
+
+# Downloading
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Timeout for establishing the connection and for every single read
+DOWNLOAD_TIMEOUT = 60
+
+
+# Prints a single self-overwriting progress line, `total` can be unknown
+def print_download_progress(done, total, speed):
+    progress = f"{done // (1024 * 1024)} MB, {speed / (1024 * 1024):.1f} MB/s"
+    if total:
+        progress = f"{min(done * 100 // total, 100)} %, " + progress
+    print("Progress:", progress, end="\r", flush=True)
+
+
+# Reads the next chunk of `response` into `view`, turning connection
+# failures and timeouts into `urllib.error.URLError`
+def read_chunk(response, view):
+    try:
+        return response.readinto(view)
+    except OSError as e:
+        raise urllib.error.URLError(e)
+
+
+class ResourceChanged(urllib.error.URLError):
+    "Raised when the remote file has changed since the download was started."
+
+    def __init__(self, url):
+        super().__init__(f"{url} has changed since the download was started")
+
+
+# Downloads `url` to `filename`, feeding `hasher` (if any) with the very same
+# bytes that are written to the disk, so that the digest is ready as soon as
+# the download is finished.
+# With `resume`, the part of `filename` that is already on the disk is hashed
+# and only the missing bytes are requested from the server. If `validator`
+# (an ETag or a Last-Modified date) is given, the range is only served
+# if the remote file still matches it. If the server doesn't serve the range,
+# the download starts from scratch.
+# The download rate is limited by `limiter` (a `RateLimiter`), if any.
+# Networking errors are raised as `urllib.error.URLError`.
+def download_file(
+    url, filename, resume=False, hasher=None, validator=None, limiter=None
+):
+    offset = 0
+    if resume and os.path.exists(filename):
+        offset = os.path.getsize(filename)
+
+    headers = dict(http_request_headers)
+    if offset > 0:
+        headers["Range"] = f"bytes={offset}-"
+        if validator is not None:
+            headers["If-Range"] = validator
+
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        # the partial file is already complete
+        if e.code == 416 and offset > 0:
+            logging.info(f"{filename} is already fully downloaded")
+            if hasher is not None:
+                update_digest_from_file(hasher, filename)
+            return
+        raise
+
+    with response:
+        if offset > 0 and response.status != 206:
+            logging.info("Can't resume the download, restarting it")
+            offset = 0
+        elif offset > 0:
+            logging.info(f"Resuming download from byte {offset}")
+            if hasher is not None:
+                update_digest_from_file(hasher, filename, length=offset)
+
+        content_length = response.headers.get("Content-Length")
+        total = offset + int(content_length) if content_length is not None else None
+
+        started = time.monotonic()
+        reported = started
+        done = offset
+        view = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        with open(filename, "r+b" if offset > 0 else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            if total is not None:
+                preallocate(f.fileno(), total)
+            try:
+                while nread := read_chunk(response, view):
+                    if limiter is not None:
+                        limiter.acquire(nread)
+                    f.write(view[:nread])
+                    if hasher is not None:
+                        hasher.update(view[:nread])
+                    done += nread
+                    now = time.monotonic()
+                    if now - reported >= 0.5:
+                        reported = now
+                        print_download_progress(
+                            done, total, (done - offset) / (now - started)
+                        )
+            finally:
+                # the size of the partial file is the resume offset
+                f.truncate(done)
+        print()
+
+    if total is not None and done < total:
+        raise urllib.error.URLError(
+            f"Connection closed after {done} out of {total} bytes"
+        )
+
+
+# Parallel downloading
+
+# Number of concurrent connections used to download a snapshot
+DOWNLOAD_CONNECTIONS = 4
+
+# Snapshots are split into ranges of this size, every range is fetched
+# (and retried on failures) independently
+DOWNLOAD_RANGE_SIZE = 64 * 1024 * 1024
+
+DOWNLOAD_RANGE_RETRIES = 5
+
+# Number of consecutive failures after which a mirror is not used anymore
+# (unless it's the last one)
+DOWNLOAD_MIRROR_FAILURES = 3
+
+
+# Bytes per second a single connection to the mirror has fetched so far
+def mirror_throughput(mirror):
+    if mirror["seconds"] == 0:
+        return float("inf")
+    return mirror["nbytes"] / mirror["seconds"]
+
+
+# Requests the first byte of `url` and returns what is known about the remote file:
+# its final url (after redirects), its size, whether byte ranges are served,
+# and the validator to use for the conditional range requests
+def probe_download(url):
+    request = urllib.request.Request(
+        url, headers={**http_request_headers, "Range": "bytes=0-0"}
+    )
+    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+        headers = response.headers
+        content_range = re.match(
+            r"bytes 0-0/([0-9]+)", headers.get("Content-Range", "")
+        )
+        ranges = response.status == 206 and content_range is not None
+        if ranges:
+            size = int(content_range.group(1))
+        else:
+            size = headers.get("Content-Length")
+            size = int(size) if size is not None else None
+        # only strong ETags can be used in 'If-Range'
+        etag = headers.get("ETag")
+        if etag is not None and etag.startswith("W/"):
+            etag = None
+        return {
+            "url": response.geturl(),
+            "size": size,
+            "ranges": ranges,
+            "validator": etag or headers.get("Last-Modified"),
+        }
+
+
+# Probes the `mirrors` urls and returns the {"url", "validator", "source"}
+# dicts of the ones that serve byte ranges of a file of the given `size`
+def probe_mirrors(mirrors, size):
+    usable = []
+    for url in mirrors:
+        try:
+            remote = probe_download(url)
+        except urllib.error.URLError as e:
+            logging.warning(f"Mirror {url} is unavailable: {e}")
+            continue
+        if not remote["ranges"] or remote["size"] != size:
+            logging.warning(f"Mirror {url} doesn't serve the same file, skipping it")
+            continue
+        usable.append(
+            {"url": remote["url"], "validator": remote["validator"], "source": url}
+        )
+    return usable
+
+
+def read_download_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_download_state(state_file, state):
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+class RangedDownload:
+    """
+    Downloads a file over several concurrent connections, each fetching its own
+    byte ranges directly into the preallocated file. The indices of the ranges
+    that are already on the disk are kept in `state_file`, so that an interrupted
+    download can be resumed. With `validator`, every range is requested
+    conditionally, so that a file that changes on the server in the meantime
+    isn't stitched from different versions.
+    The connections share the `limiter` rate limit, if any, and with `background`
+    they run with the lowered CPU and IO priority.
+    The ranges can also be fetched from the `mirrors` serving the identical file,
+    given as {"url", "validator"} dicts. Every mirror gets its own `connections`,
+    which pull the ranges one by one, so the faster mirrors fetch more of them.
+    Mirrors that keep failing or whose file has changed are dropped.
+    """
+
+    def __init__(
+        self,
+        url,
+        filename,
+        state_file,
+        size,
+        connections=DOWNLOAD_CONNECTIONS,
+        range_size=DOWNLOAD_RANGE_SIZE,
+        validator=None,
+        source=None,
+        limiter=None,
+        background=False,
+        mirrors=(),
+    ):
+        self.url = url
+        self.filename = filename
+        self.state_file = state_file
+        self.size = size
+        self.connections = connections
+        self.range_size = range_size
+        self.validator = validator
+        self.source = url if source is None else source
+        self.limiter = limiter
+        self.background = background
+        self.ranges_count = (size + range_size - 1) // range_size
+        self.done = set()
+        self.downloaded = 0
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.mirrors = [{"url": url, "validator": validator}] + list(mirrors)
+        for mirror in self.mirrors:
+            mirror.update(slots=connections, failures=0, nbytes=0, seconds=0.0)
+        self.all_mirrors = list(self.mirrors)
+        self.mirror_available = threading.Condition(self.lock)
+
+    def load_state(self):
+        state = read_download_state(self.state_file)
+        if (
+            state.get("size"),
+            state.get("range_size"),
+            state.get("validator"),
+        ) == (
+            self.size,
+            self.range_size,
+            self.validator,
+        ) and os.path.exists(self.filename):
+            self.done = set(state.get("done", []))
+            logging.info(f"Resuming download, {len(self.done)} ranges are done")
+
+    def save_state(self):
+        write_download_state(
+            self.state_file,
+            {
+                "source": self.source,
+                "validator": self.validator,
+                "size": self.size,
+                "range_size": self.range_size,
+                "done": sorted(self.done),
+            },
+        )
+
+    def range_bounds(self, index):
+        start = index * self.range_size
+        return (start, min(start + self.range_size, self.size))
+
+    # Takes a connection slot of the mirror with the best throughput measured
+    # so far, mirrors that haven't been measured yet are tried first
+    def acquire_mirror(self):
+        with self.mirror_available:
+            while True:
+                if not self.mirrors:
+                    raise urllib.error.URLError("No mirror is available")
+                free = [mirror for mirror in self.mirrors if mirror["slots"] > 0]
+                if free:
+                    mirror = max(free, key=mirror_throughput)
+                    mirror["slots"] -= 1
+                    return mirror
+                self.mirror_available.wait(0.5)
+
+    def release_mirror(self, mirror, nbytes, seconds):
+        with self.mirror_available:
+            mirror["slots"] += 1
+            mirror["nbytes"] += nbytes
+            mirror["seconds"] += seconds
+            self.mirror_available.notify()
+
+    # Drops the failed `mirror` unless it's the last one, returns whether it was dropped
+    def drop_mirror(self, mirror, reason):
+        with self.mirror_available:
+            if mirror not in self.mirrors:
+                return True
+            if len(self.mirrors) == 1:
+                return False
+            self.mirrors.remove(mirror)
+            self.mirror_available.notify_all()
+        logging.warning(f"Not using {mirror['url']} anymore: {reason}")
+        return True
+
+    def fetch_range(self, fd, index):
+        pos, end = self.range_bounds(index)
+        view = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        attempt = 0
+        while pos < end:
+            if self.stop.is_set():
+                raise InterruptedError
+            mirror = self.acquire_mirror()
+            started = time.monotonic()
+            fetched = 0
+            try:
+                headers = {**http_request_headers, "Range": f"bytes={pos}-{end - 1}"}
+                if mirror["validator"] is not None:
+                    headers["If-Range"] = mirror["validator"]
+                request = urllib.request.Request(mirror["url"], headers=headers)
+                with urllib.request.urlopen(
+                    request, timeout=DOWNLOAD_TIMEOUT
+                ) as response:
+                    if response.status == 200 and mirror["validator"] is not None:
+                        raise ResourceChanged(mirror["url"])
+                    if response.status != 206:
+                        raise urllib.error.URLError("Server stopped serving ranges")
+                    while pos < end and not self.stop.is_set():
+                        nread = read_chunk(response, view[: end - pos])
+                        if not nread:
+                            raise urllib.error.URLError(
+                                f"Connection closed at byte {pos}"
+                            )
+                        if self.limiter is not None:
+                            self.limiter.acquire(nread)
+                        os.pwrite(fd, view[:nread], pos)
+                        pos += nread
+                        fetched += nread
+                        with self.lock:
+                            self.downloaded += nread
+                mirror["failures"] = 0
+            except ResourceChanged as e:
+                if not self.drop_mirror(mirror, e.reason):
+                    raise
+            except urllib.error.URLError as e:
+                with self.lock:
+                    mirror["failures"] += 1
+                    failures = mirror["failures"]
+                if failures >= DOWNLOAD_MIRROR_FAILURES:
+                    self.drop_mirror(mirror, e.reason)
+                attempt += 1
+                if attempt > DOWNLOAD_RANGE_RETRIES:
+                    raise
+                delay = min(2**attempt, 30) + random.random()
+                logging.warning(
+                    f"Range {index} failed ({e}), retrying in {delay:.1f}s from byte {pos}"
+                )
+                time.sleep(delay)
+            finally:
+                self.release_mirror(mirror, fetched, time.monotonic() - started)
+        return index
+
+    # Downloads all the missing ranges and feeds `hasher` with the contents
+    # of the file in order, as soon as the contiguous prefix of it is complete
+    def run(self, resume=False, hasher=None):
+        if resume:
+            self.load_state()
+        else:
+            self.done = set()
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+        self.save_state()
+
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # reserve the file size upfront, ranges are written in place
+            preallocate(fd, self.size)
+
+            hashed = 0
+            started = time.monotonic()
+            with ThreadPoolExecutor(
+                max_workers=self.connections * len(self.mirrors),
+                initializer=lower_thread_priority if self.background else None,
+            ) as executor:
+                pending = {
+                    executor.submit(self.fetch_range, fd, index)
+                    for index in range(self.ranges_count)
+                    if index not in self.done
+                }
+                try:
+                    while pending or hashed < self.ranges_count:
+                        if pending:
+                            completed, pending = wait(
+                                pending, timeout=0.5, return_when=FIRST_COMPLETED
+                            )
+                            for future in completed:
+                                self.done.add(future.result())
+                            if completed:
+                                self.save_state()
+                        while hashed in self.done:
+                            if hasher is not None:
+                                start, end = self.range_bounds(hashed)
+                                update_digest_from_file(
+                                    hasher,
+                                    self.filename,
+                                    length=end - start,
+                                    offset=start,
+                                )
+                            hashed += 1
+                        elapsed = time.monotonic() - started
+                        print_download_progress(
+                            min(len(self.done) * self.range_size, self.size),
+                            self.size,
+                            self.downloaded / elapsed if elapsed > 0 else 0.0,
+                        )
+                except BaseException:
+                    self.stop.set()
+                    raise
+            print()
+            if len(self.all_mirrors) > 1:
+                for mirror in self.all_mirrors:
+                    logging.info(
+                        f"{mirror['url']}: {mirror['nbytes']} bytes, "
+                        f"{mirror_throughput(mirror) / 1024**2:.2f} MB/s per connection"
+                    )
+        finally:
+            os.close(fd)
+
+
+# Downloads `url` to `filename` over several connections if the server supports
+# byte ranges, and over a single one otherwise. See `download_file` for
+# the meaning of `resume`.
+# The size and the validator of the remote file are kept in `state_file`.
+# With `conditional`, the download is only resumed if they are known and
+# haven't changed, which makes resuming safe even without a checksum to verify
+# the final file against.
+# If `digest` is given, returns the hex digest of the downloaded file
+# computed during the download.
+# The download rate is limited by `limiter`, if any, and with `background`
+# the download runs with the lowered CPU and IO priority.
+# `preflight`, if any, is called with the size of the remote file (None if
+# it's unknown) and the number of bytes that are missing on the disk before
+# the download starts, e.g. to check the free space.
+# The ranges are also fetched from the `mirrors` urls that serve a file
+# of the same size. The caller has to ensure that the mirrors serve
+# the identical file, e.g. by the checksums advertised by their providers.
+def download_snapshot(
+    url,
+    filename,
+    state_file,
+    resume=False,
+    digest=None,
+    connections=DOWNLOAD_CONNECTIONS,
+    conditional=False,
+    limiter=None,
+    background=False,
+    preflight=None,
+    mirrors=(),
+):
+    try:
+        remote = probe_download(url)
+    except urllib.error.HTTPError:
+        remote = {"url": url, "size": None, "ranges": False, "validator": None}
+
+    state = read_download_state(state_file) if resume else {}
+    validator = remote["validator"]
+    if resume and (
+        # the remote file has certainly changed
+        (state.get("validator") and state.get("validator") != validator)
+        or (state.get("size") and state.get("size") != remote["size"])
+        or (
+            conditional
+            and (
+                validator is None
+                or state.get("validator") != validator
+                or state.get("source") != url
+            )
+        )
+    ):
+        logging.info("Can't ensure the partial download is up to date, restarting")
+        resume = False
+
+    if preflight is not None:
+        existing = (
+            os.path.getsize(filename) if resume and os.path.exists(filename) else 0
+        )
+        size = remote["size"]
+        preflight(size, None if size is None else max(size - existing, 0))
+
+    hasher = None if digest is None else TimedDigest(new_digest(digest))
+
+    if not remote["ranges"] or connections <= 1:
+        logging.info("Downloading the snapshot over a single connection")
+        write_download_state(
+            state_file,
+            {"source": url, "validator": validator, "size": remote["size"]},
+        )
+        if background:
+            run_in_background(
+                download_file, url, filename, resume, hasher, validator, limiter
+            )
+        else:
+            download_file(url, filename, resume, hasher, validator, limiter)
+    else:
+        mirrors = probe_mirrors(mirrors, remote["size"])
+        logging.info(
+            f"Downloading {remote['size']} bytes over {connections} connections"
+            + (f" to each of {len(mirrors) + 1} mirrors" if mirrors else "")
+        )
+        try:
+            RangedDownload(
+                remote["url"],
+                filename,
+                state_file,
+                remote["size"],
+                connections,
+                validator=validator,
+                source=url,
+                limiter=limiter,
+                background=background,
+                mirrors=mirrors,
+            ).run(resume, hasher)
+        except ResourceChanged:
+            logging.warning(f"{url} has changed during the download, restarting it")
+            return download_snapshot(
+                url,
+                filename,
+                state_file,
+                False,
+                digest,
+                connections,
+                limiter=limiter,
+                background=background,
+                preflight=preflight,
+                mirrors=[mirror["source"] for mirror in mirrors],
+            )
+
+    if hasher is None:
+        return None
+    logging.info(f"{hasher.name} of {filename}: {hasher.stats}")
+    return hasher.hexdigest()
+
+
+# Streaming
+
+
+# Opens the named pipe `fifo` for writing once the `reader` process has opened
+# it for reading. Raises `ChildProcessError` if the reader exits before that,
+# so that the wizard doesn't hang forever on a failed reader.
+def open_fifo_for_writing(fifo, reader):
+    while True:
+        try:
+            fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            if reader.poll() is not None:
+                raise ChildProcessError(
+                    f"{fifo} reader exited with code {reader.returncode}"
+                )
+            time.sleep(0.1)
+        else:
+            os.set_blocking(fd, True)
+            return fd
+
+
+def write_all(fd, view):
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+# Downloads `url` and writes it sequentially to the `fd` descriptor (e.g. a pipe
+# read by another process), feeding `hasher` with the same bytes.
+# `verify` (if any) is called with the final digest once everything is written,
+# the reader has to discard what it has read if it raises.
+# `preflight`, if any, is called with the size of the remote file (None if
+# it's unknown) before anything is written.
+def stream_file(url, fd, hasher=None, verify=None, preflight=None):
+    if hasher is not None:
+        hasher = TimedDigest(hasher)
+    request = urllib.request.Request(url, headers=http_request_headers)
+    with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+        content_length = response.headers.get("Content-Length")
+        total = int(content_length) if content_length is not None else None
+        if preflight is not None:
+            preflight(total)
+
+        buffer = memoryview(bytearray(DOWNLOAD_CHUNK_SIZE))
+        started = time.monotonic()
+        reported = started
+        done = 0
+        while nread := read_chunk(response, buffer):
+            if hasher is not None:
+                hasher.update(buffer[:nread])
+            write_all(fd, buffer[:nread])
+            done += nread
+            now = time.monotonic()
+            if now - reported >= 0.5:
+                reported = now
+                print_download_progress(done, total, done / (now - started))
+        print()
+
+    if total is not None and done < total:
+        raise urllib.error.URLError(
+            f"Connection closed after {done} out of {total} bytes"
+        )
+    if hasher is not None:
+        logging.info(f"{hasher.name} of {url}: {hasher.stats}")
+    if verify is not None:
+        verify(hasher.hexdigest())
+
+
+# Placing
+
+# ioctl request that makes the destination file share the extents of the source
+# file on the copy-on-write filesystems (btrfs, xfs with reflink, ...)
+FICLONE = 0x40049409
+
+
+def reflink_file(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            os.remove(dst)
+            raise
+
+
+# Copies `size` bytes from `fsrc` to `fdst` descriptors inside the kernel,
+# with `copy_file_range` where it's supported and `sendfile` otherwise,
+# so the contents never pass through the user space
+def kernel_copy(fsrc, fdst, size):
+    offset = 0
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    while offset < size:
+        count = min(size - offset, 1024**3)
+        if use_copy_file_range:
+            try:
+                copied = os.copy_file_range(fsrc, fdst, count, offset, offset)
+            except OSError as e:
+                # cross-filesystem copies aren't supported by the older kernels
+                if e.errno not in [
+                    errno.EXDEV,
+                    errno.ENOSYS,
+                    errno.EINVAL,
+                    errno.EOPNOTSUPP,
+                ]:
+                    raise
+                use_copy_file_range = False
+                continue
+        else:
+            os.lseek(fdst, offset, os.SEEK_SET)
+            copied = os.sendfile(fdst, fsrc, offset, count)
+        if copied == 0:
+            raise OSError(errno.EIO, "Source file was truncated while being copied")
+        offset += copied
+
+
+def kernel_copy_file(src, dst):
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            kernel_copy(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+    except OSError:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+# Places the `src` file at `dst` without passing its contents through
+# the user space, trying the cheapest method first: a hard link, a reflink,
+# and, if `copy` is allowed, an in-kernel copy.
+# Returns the name of the used method or None if none of them has worked.
+def place_file(src, dst, copy=True):
+    methods = [("hard link", os.link), ("reflink", reflink_file)]
+    if copy:
+        methods.append(("copy", kernel_copy_file))
+    for method, place in methods:
+        try:
+            place(src, dst)
+        except OSError as e:
+            logging.info(f"Couldn't place {src} at {dst} with a {method}: {e}")
+            continue
+        logging.info(f"Placed {src} at {dst} with a {method}")
+        return method
+    return None
+
+
+# Snapshot cache
+
+SNAPSHOT_CACHE_DIR = os.path.join(CACHE_DIR, "snapshots/")
+
+# Default byte budget and maximal age (in days) of the cached snapshots,
+# the cache is disabled unless a budget is given
+SNAPSHOT_CACHE_SIZE = 0
+SNAPSHOT_CACHE_MAX_AGE = 14
+# Free space in bytes that the cached snapshots leave on their filesystem,
+# so that they don't take the space the node needs for its data
+SNAPSHOT_CACHE_MIN_FREE = 16 * 1024**3
+
+
+class SnapshotCache:
+    """
+    Persistent snapshot storage shared between the wizard runs.
+
+    Snapshots are addressed by their sha256 or, when it's unknown, by the block
+    hash and the url they were downloaded from. The `index.json` file keeps
+    the entries along with their last use time, the least recently used entries
+    are evicted once the cache exceeds `max_size` bytes or leaves less than
+    `SNAPSHOT_CACHE_MIN_FREE` bytes free, and entries unused for more than
+    `max_age` days are evicted regardless of the size.
+    The cache is best-effort: when it can't be used, the snapshot
+    is just left where it was downloaded.
+    """
+
+    def __init__(
+        self,
+        directory=SNAPSHOT_CACHE_DIR,
+        max_size=SNAPSHOT_CACHE_SIZE,
+        max_age=SNAPSHOT_CACHE_MAX_AGE,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.index_file = os.path.join(directory, "index.json")
+
+    def enabled(self):
+        return self.max_size > 0
+
+    # Holds an exclusive lock on the index, so that concurrent wizards
+    # don't corrupt it, and yields its entries, saving them afterwards
+    @contextlib.contextmanager
+    def index(self):
+        ensure_private_dir(self.directory)
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_file, "r") as f:
+                    entries = json.load(f)["entries"]
+            except (OSError, ValueError, KeyError):
+                entries = []
+            # drop the entries whose files were removed behind our back
+            entries = [e for e in entries if os.path.exists(self.path(e["file"]))]
+            yield entries
+            with open(self.index_file + ".tmp", "w") as f:
+                json.dump({"entries": entries}, f, indent=2)
+            os.replace(self.index_file + ".tmp", self.index_file)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def key(sha256=None, block_hash=None, url=None):
+        if sha256:
+            return sha256
+        if block_hash and url:
+            return block_hash + "-" + hashlib.sha256(url.encode()).hexdigest()[:16]
+        return None
+
+    @staticmethod
+    def matches(entry, sha256=None, block_hash=None, url=None):
+        if sha256:
+            return entry["sha256"] == sha256
+        return (entry["block_hash"], entry["url"]) == (block_hash, url)
+
+    # Returns the cached entry of the snapshot, if any
+    def lookup(self, sha256=None, block_hash=None, url=None):
+        if not self.enabled() or self.key(sha256, block_hash, url) is None:
+            return None
+        try:
+            with self.index() as entries:
+                for entry in entries:
+                    if self.matches(entry, sha256, block_hash, url):
+                        entry["last_used"] = time.time()
+                        logging.info(f"Snapshot cache hit: {entry['file']}")
+                        return dict(entry, path=self.path(entry["file"]))
+        except OSError as e:
+            logging.warning(f"Couldn't read the snapshot cache: {e}")
+            return None
+        logging.info("Snapshot cache miss")
+        return None
+
+    # Moves the downloaded `filename` into the cache and returns its new path,
+    # or returns None if the snapshot can't be cached
+    def store(self, filename, sha256=None, block_hash=None, url=None):
+        key = self.key(sha256, block_hash, url)
+        if not self.enabled() or key is None:
+            return None
+        try:
+            return self.move_in(filename, key, sha256, block_hash, url)
+        except OSError as e:
+            logging.warning(f"Couldn't store the snapshot in the cache: {e}")
+            return None
+
+    def move_in(self, filename, key, sha256, block_hash, url):
+        size = os.path.getsize(filename)
+        if size > self.max_size:
+            logging.info(f"Snapshot of {size} bytes exceeds the cache budget")
+            return None
+        with self.index() as entries:
+            # the snapshot is only ever renamed into the cache, copying
+            # it would take as much time and space as downloading it again
+            device, available = filesystem_free_space(self.directory)
+            if os.stat(filename).st_dev != device:
+                logging.info("Snapshot cache is on another filesystem, not caching")
+                return None
+            entries[:] = [
+                e for e in entries if not self.matches(e, sha256, block_hash, url)
+            ]
+            # the downloaded snapshot already takes its space, keeping it
+            # only means that this space isn't freed after the import
+            if available + sum(e["size"] for e in entries) < SNAPSHOT_CACHE_MIN_FREE:
+                logging.info(
+                    f"Only {available} bytes are free on the snapshot cache "
+                    "filesystem, not caching"
+                )
+                return None
+            self.evict(entries, self.max_size - size)
+            _, available = filesystem_free_space(self.directory)
+            while entries and available < SNAPSHOT_CACHE_MIN_FREE:
+                available += self.remove(entries.pop(0))
+            name = key + ".snapshot"
+            try:
+                os.replace(filename, self.path(name))
+            except OSError as e:
+                # e.g. different mount points of the same filesystem
+                if e.errno != errno.EXDEV:
+                    raise
+                logging.info("Snapshot cache is on another mount point, not caching")
+                return None
+            os.chmod(self.path(name), 0o644)
+            now = time.time()
+            entries.append(
+                {
+                    "file": name,
+                    "size": size,
+                    "sha256": sha256,
+                    "block_hash": block_hash,
+                    "url": url,
+                    "added": now,
+                    "last_used": now,
+                }
+            )
+        logging.info(f"Stored the snapshot in the cache as {name}")
+        return self.path(name)
+
+    # Removes expired entries and then the least recently used ones
+    # until the cache takes no more than `budget` bytes
+    def evict(self, entries, budget):
+        expiry = time.time() - self.max_age * 24 * 60 * 60
+        entries.sort(key=lambda e: e["last_used"])
+        while entries and (
+            entries[0]["last_used"] < expiry or sum(e["size"] for e in entries) > budget
+        ):
+            self.remove(entries.pop(0))
+
+    # Removes the file of the evicted entry and returns its size
+    def remove(self, entry):
+        logging.info(f"Evicting {entry['file']} from the snapshot cache")
+        try:
+            os.remove(self.path(entry["file"]))
+        except FileNotFoundError:
+            pass
+        return entry["size"]
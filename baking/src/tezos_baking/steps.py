@@ -6,10 +6,16 @@ Contains step class definition along with the common steps shared between wizard
 """
 
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 import textwrap
+import threading
+import logging
 import sys
 
 from tezos_baking.util import *
+from tezos_baking.rpc import *
+from tezos_baking.node_monitor import get_balance, format_tez
+from tezos_baking.ledger import ledger_lock
 from tezos_baking.validators import Validator
 import tezos_baking.validators as validators
 
@@ -162,30 +168,53 @@ def get_ledger_url_query(ledgers):
     )
 
 
+# Number of the balances fetched from the node at once
+LEDGER_BALANCE_WORKERS = 4
+
+
+# The addresses are read from the ledgers one at a time, since octez-client
+# finds a ledger by querying every connected one, so concurrent calls would
+# interleave the APDU exchanges on the devices. The balances of the already
+# read addresses are fetched from the node meanwhile, and every row is printed
+# as soon as it's complete.
 def ledger_urls_info(ledgers_derivations, node_endpoint, client_dir):
-    ledgers_info = {}
     max_derivation_len = 0
     for derivations_paths in ledgers_derivations.values():
         max_derivation_len = max(max_derivation_len, max(map(len, derivations_paths)))
+    row_format = "{:" + str(max_derivation_len + 1) + "} address: {}, balance: {}"
+    rows = {}
+    lock = threading.Lock()
+
+    def fetch_balance(ledger_url, derivation_path, addr):
+        try:
+            balance = format_tez(get_balance(node_endpoint, addr))
+        except (RpcError, ValueError) as e:
+            logging.info(f"Couldn't get the balance of {addr}: {e}")
+            balance = "unknown"
+        row = row_format.format(derivation_path + ",", addr, balance)
+        with lock:
+            rows[(ledger_url, derivation_path)] = row
+            print(ledger_url + row, flush=True)
+
+    print("Reading the keys from the ledgers...")
+    with ThreadPoolExecutor(max_workers=LEDGER_BALANCE_WORKERS) as balances:
+        for ledger_url, derivations_paths in ledgers_derivations.items():
+            for derivation_path in derivations_paths:
+                with ledger_lock:
+                    output = get_proc_output(
+                        f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} "
+                        f"show ledger {ledger_url + derivation_path}"
+                    ).stdout
+                addr = re.search(address_regex, output).group(0).decode()
+                balances.submit(fetch_balance, ledger_url, derivation_path, addr)
+    print()
+
+    # the rows are ordered as the options are
+    ledgers_info = {}
     for ledger_url, derivations_paths in ledgers_derivations.items():
         for derivation_path in derivations_paths:
-            output = get_proc_output(
-                f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} "
-                f"show ledger {ledger_url + derivation_path}"
-            ).stdout
-            addr = re.search(address_regex, output).group(0).decode()
-            balance = (
-                get_proc_output(
-                    f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} "
-                    f"--endpoint {node_endpoint} get balance for {addr}"
-                )
-                .stdout.decode()
-                .strip()
-            )
             ledgers_info.setdefault(ledger_url, []).append(
-                (
-                    "{:" + str(max_derivation_len + 1) + "} address: {}, balance: {}"
-                ).format(derivation_path + ",", addr, balance)
+                rows[(ledger_url, derivation_path)]
             )
     return ledgers_info
 
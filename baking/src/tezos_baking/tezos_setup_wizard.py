@@ -8,7 +8,10 @@ A wizard utility to help set up tezos-baker.
 Asks questions, validates answers, and executes the appropriate steps using the final configuration.
 """
 
-import os, sys, shutil
+import os, sys, shutil, shlex
+import contextlib
+import socket
+import hashlib
 import readline
 import re
 import time
@@ -21,6 +24,8 @@ from tezos_baking.wizard_structure import *
 from tezos_baking.util import *
 from tezos_baking.steps import *
 from tezos_baking.provider import *
+from tezos_baking.snapshot import *
+from tezos_baking.node_monitor import *
 from tezos_baking.validators import Validator
 import tezos_baking.validators as validators
 
@@ -51,6 +56,65 @@ toggle_vote_modes = {
 
 TMP_SNAPSHOT_LOCATION = "/tmp/octez_node.snapshot.d/"
 
+# Command line argument parsing
+
+parser.add_argument(
+    "--snapshot-cache-dir",
+    required=False,
+    default=SNAPSHOT_CACHE_DIR,
+    help="Directory to keep the downloaded snapshots in, so that they can be reused "
+    "by the next runs of the wizard. Is '%(default)s' by default.",
+)
+
+parser.add_argument(
+    "--snapshot-cache-size",
+    required=False,
+    type=float,
+    default=SNAPSHOT_CACHE_SIZE / 1024**3,
+    help="Maximal size of the snapshot cache in GiB, the least recently used "
+    "snapshots are removed to fit into it. The cache is disabled by default "
+    "or with 0.",
+)
+
+parser.add_argument(
+    "--snapshot-cache-max-age",
+    required=False,
+    type=float,
+    default=SNAPSHOT_CACHE_MAX_AGE,
+    help="Number of days after which an unused cached snapshot is removed. "
+    "Is %(default)s days by default.",
+)
+
+parser.add_argument(
+    "--metadata-cache-ttl",
+    required=False,
+    type=int,
+    default=METADATA_CACHE_TTL,
+    help="Number of seconds during which the cached snapshot providers metadata "
+    "is used without asking the providers whether it has changed. "
+    "Is %(default)s seconds by default.",
+)
+
+parser.add_argument(
+    "--experimental-snapshot-stream",
+    action="store_true",
+    help="Offer the experimental snapshot download mode that imports the snapshot "
+    "while it is being downloaded. It hasn't been verified with all the octez-node "
+    "versions, the failed imports are cleaned up.",
+)
+
+parsed_args = parser.parse_args()
+
+snapshot_cache = SnapshotCache(
+    parsed_args.snapshot_cache_dir,
+    int(parsed_args.snapshot_cache_size * 1024**3),
+    parsed_args.snapshot_cache_max_age,
+)
+
+metadata_cache.ttl = parsed_args.metadata_cache_ttl
+
+ledger_monitor.timeout = parsed_args.ledger_timeout
+
 
 # Wizard CLI utility
 
@@ -71,13 +135,21 @@ Type in 'exit' to quit.
 """
 
 
-def fetch_snapshot(url, sha256=None):
+# `download_options` are passed to `download_snapshot`
+def fetch_snapshot(url, sha256=None, block_hash=None, **download_options):
 
     logging.info("Fetching snapshot")
 
+    cached = snapshot_cache.lookup(sha256, block_hash, url)
+    if cached is not None:
+        print_and_log(f"Using the previously downloaded snapshot {cached['path']}")
+        return (cached["path"], cached["sha256"])
+
     dirname = TMP_SNAPSHOT_LOCATION
     filename = os.path.join(dirname, "octez_node.snapshot")
     metadata_file = os.path.join(dirname, "octez_node.snapshot.sha256")
+    # validators of the remote snapshot and its ranges that are already downloaded
+    state_file = os.path.join(dirname, "octez_node.snapshot.ranges")
 
     # updates or removes the 'metadata_file' containing the snapshot's SHA256
     def dump_metadata(metadata_file=metadata_file, sha256=sha256):
@@ -99,23 +171,15 @@ def fetch_snapshot(url, sha256=None):
         else:
             return None
 
-    def download(filename=filename, url=url, args=""):
-        from subprocess import CalledProcessError
-
-        try:
-            proc_call(f"wget {args} --show-progress -O {filename} {url}")
-        except CalledProcessError as e:
-            # see here https://www.gnu.org/software/wget/manual/html_node/Exit-Status.html
-            if e.returncode >= 4:
-                raise urllib.error.URLError
-            else:
-                raise e
-
     print_and_log(f"Downloading the snapshot from {url}")
 
     # expected for the (possibly) existing chunk
     expected_sha256 = read_metadata()
 
+    # the digest is computed on the fly, so that the integrity check
+    # doesn't require reading the whole snapshot once again
+    digest = hashlib.sha256 if sha256 else None
+
     os.makedirs(dirname, exist_ok=True)
     if sha256 and expected_sha256 and expected_sha256 == sha256:
         logging.info("Continuing download")
@@ -123,8 +187,22 @@ def fetch_snapshot(url, sha256=None):
         # we want to download is the same as the expected
         # sha256 of the existing octez_node.snapshot file
         # when it will be fully downloaded
-        # so that we can safely use `--continue` option here
-        download(args="--continue")
+        # so that we can safely resume the download here
+        actual_sha256 = download_snapshot(
+            url, filename, state_file, resume=True, digest=digest, **download_options
+        )
+    elif not sha256 and not expected_sha256:
+        # without sha256 the existing octez_node.snapshot chunk can only
+        # be resumed if the server confirms that the file hasn't changed
+        # since the chunk was downloaded
+        actual_sha256 = download_snapshot(
+            url,
+            filename,
+            state_file,
+            resume=True,
+            conditional=True,
+            **download_options,
+        )
     else:
         # all other cases we just dump new metadata
         # (so that we can resume download if we can ensure
@@ -132,10 +210,20 @@ def fetch_snapshot(url, sha256=None):
         # to the snapshot we want to download)
         # and start download from scratch
         dump_metadata()
-        download()
+        actual_sha256 = download_snapshot(
+            url, filename, state_file, digest=digest, **download_options
+        )
 
     print()
-    return filename
+
+    # snapshots that fail the integrity check aren't worth keeping
+    if not sha256 or actual_sha256 == sha256:
+        cached_filename = snapshot_cache.store(filename, sha256, block_hash, url)
+        if cached_filename is not None:
+            dump_metadata(sha256=None)
+            filename = cached_filename
+
+    return (filename, actual_sha256)
 
 
 class Sha256Mismatch(Exception):
@@ -150,17 +238,7 @@ class InterruptStep(Exception):
     "Raised when there is need to interrupt step handling flow."
 
 
-def check_file_contents_integrity(filename, sha256):
-    import hashlib
-
-    sha256sum = hashlib.sha256()
-    with open(filename, "rb") as f:
-        contents = f.read()
-    sha256sum.update(contents)
-
-    actual_sha256 = str(sha256sum.hexdigest())
-    expected_sha256 = sha256
-
+def check_sha256(actual_sha256, expected_sha256):
     if actual_sha256 != expected_sha256:
         raise Sha256Mismatch(actual_sha256, expected_sha256)
 
@@ -170,12 +248,16 @@ def is_full_snapshot(snapshot_file, import_mode):
         return True
     if import_mode == "file" or import_mode == "url":
         output = get_proc_output(
-            "sudo -u tezos octez-node snapshot info " + snapshot_file
+            "sudo -u tezos octez-node snapshot info " + shlex.quote(snapshot_file)
         ).stdout
         return re.search(b"at level [0-9]+ in full", output) is not None
     return False
 
 
+def readable_by_tezos(path):
+    return get_proc_output(f"sudo -u tezos test -r {shlex.quote(path)}").returncode == 0
+
+
 def is_non_protocol_testnet(network):
     return network == "mainnet" or network == "ghostnet"
 
@@ -235,6 +317,7 @@ liquidity_toggle_vote_query = Step(
 )
 
 regions = {
+    "auto": "Measure the speed of every region and choose the fastest one",
     "eu": "European region",
     "us": "US region",
     "asia": "Asian region",
@@ -293,6 +376,57 @@ def get_snapshot_mode_query(config):
     )
 
 
+snapshot_download_modes = {
+    "temporary file": "Download the snapshot to a temporary file and import it afterwards",
+    "background": "Download the snapshot to a temporary file with a limited rate "
+    "and a low CPU and IO priority, so that the other services on this machine "
+    "aren't disturbed",
+}
+
+snapshot_download_mode_help = (
+    "The background download doesn't disturb the other services on this machine,\n"
+    "but takes longer."
+)
+
+# octez-node may need to read the snapshot file more than once,
+# which a pipe doesn't allow, so streaming is only offered on request
+if parsed_args.experimental_snapshot_stream:
+    snapshot_download_modes["stream"] = (
+        "(experimental) Import the snapshot while it is being downloaded, "
+        "without a temporary file"
+    )
+    snapshot_download_mode_help = (
+        "Streaming the snapshot into the node overlaps the download with the import\n"
+        "and doesn't require disk space for the snapshot file itself.\n"
+        "However, an interrupted stream can't be resumed, and a snapshot that fails\n"
+        "the sha256 check is discarded."
+    )
+
+snapshot_download_mode_query = Step(
+    id="snapshot_download_mode",
+    prompt="How would you like to download the snapshot?",
+    help=snapshot_download_mode_help,
+    options=snapshot_download_modes,
+    validator=Validator(validators.enum_range(snapshot_download_modes)),
+)
+
+# the rate limit of the background download can be changed
+# by writing a new one to this file while the download runs
+SNAPSHOT_RATE_CONTROL_FILE = os.path.join(
+    TMP_SNAPSHOT_LOCATION, "octez_node.snapshot.rate"
+)
+
+snapshot_download_rate_query = Step(
+    id="snapshot_download_rate",
+    prompt="Provide the download rate limit, e.g. '10M' for 10 MiB/s.",
+    help="The snapshot download won't use more network bandwidth than this,\n"
+    "use '0' to download the snapshot without a rate limit.\n"
+    "The limit can be changed during the download by writing a new one\n"
+    f"to {SNAPSHOT_RATE_CONTROL_FILE}.",
+    default="10M",
+    validator=Validator(validators.download_rate),
+)
+
 delete_node_data_options = {
     "no": "Keep the existing data",
     "yes": "Remove the data under the tezos node data directory",
@@ -406,7 +540,31 @@ def get_stake_tez_query(staked_balance, minimal_frozen_stake):
     )
 
 
+# Content expected in a configured and clean node data dir
+node_dir_config = set(["config.json", "version.json"])
+# Content that isn't blockchain data and is kept on import
+node_dir_keep = set(["identity.json"])
+
+
+def remove_node_dir_paths(node_dir, paths):
+    for path in paths:
+        try:
+            proc_call("sudo rm -r " + os.path.join(node_dir, path))
+        except:
+            logging.error("Could not clean the Tezos node data directory.")
+            print(
+                "Could not clean the Tezos node data directory. "
+                "Please do so manually."
+            )
+            raise OSError("'sudo rm -r " + os.path.join(node_dir, path) + "' failed.")
+
+
 class Setup(Setup):
+    def __init__(self, config={}):
+        super().__init__(config)
+        # the background node identity generation, if any
+        self.identity_generation = None
+
     # Check if there is already some blockchain data in the octez-node data directory,
     # and ask the user if it can be overwritten.
     def check_blockchain_data(self):
@@ -421,9 +579,6 @@ class Setup(Setup):
             proc_call("sudo mkdir " + node_dir)
             proc_call("sudo chown tezos:tezos " + node_dir)
 
-        # Content expected in a configured and clean node data dir
-        node_dir_config = set(["config.json", "version.json"])
-
         # Configure data dir if the config is missing
         if not node_dir_config.issubset(node_dir_contents):
             print_and_log("The Tezos node data directory has not been configured yet.")
@@ -439,7 +594,7 @@ class Setup(Setup):
                 + self.config["node_rpc_addr"]
             )
 
-        diff = node_dir_contents - node_dir_config
+        diff = node_dir_contents - node_dir_config - node_dir_keep
         if diff:
             logging.info(
                 "The Tezos node data directory already has some blockchain data"
@@ -456,33 +611,34 @@ class Setup(Setup):
                     + self.config["network"]
                     + ".service"
                 )
-                for path in diff:
-                    try:
-                        proc_call("sudo rm -r " + os.path.join(node_dir, path))
-                    except:
-                        logging.error("Could not clean the Tezos node data directory.")
-                        print(
-                            "Could not clean the Tezos node data directory. "
-                            "Please do so manually."
-                        )
-                        raise OSError(
-                            "'sudo rm -r " + os.path.join(node_dir, path) + "' failed."
-                        )
+                remove_node_dir_paths(node_dir, diff)
 
                 print_and_log("Node directory cleaned.")
                 return True
             return False
         return True
 
+    # Removes the blockchain data, e.g. left by a failed snapshot import,
+    # from the node data directory, keeping its config and identity
+    def remove_blockchain_data(self):
+        node_dir = get_data_dir(self.config["network"])
+        diff = set(os.listdir(node_dir)) - node_dir_config - node_dir_keep
+        if diff:
+            print_and_log("Removing the partially imported blockchain data.")
+            remove_node_dir_paths(node_dir, diff)
+
     # Check the provider url and collect the most recent snapshot
     # that is suited for the chosen history mode and network
     def get_snapshot_metadata(self, provider: Provider):
         try:
+            started = time.monotonic()
             snapshot_metadata = provider.get_snapshot_metadata(
                 self.config["network"],
                 self.config["history_mode"],
                 self.config["region"],
             )
+            latency = time.monotonic() - started
+            logging.info(f"{provider.title} metadata collected in {latency:.2f}s")
             if snapshot_metadata is None:
                 print_and_log(
                     f"No suitable snapshot found from the {provider.title} provider.",
@@ -490,9 +646,10 @@ class Setup(Setup):
                     colorcode=color_yellow,
                 )
             else:
+                snapshot_metadata["latency"] = latency
                 self.config["snapshots"][provider.title] = snapshot_metadata
 
-        except urllib.error.URLError:
+        except (urllib.error.URLError, socket.timeout):
             print_and_log(
                 f"\nCouldn't collect snapshot metadata from {provider.metadata_url} due to networking issues.\n",
                 log=logging.error,
@@ -544,14 +701,96 @@ block timestamp: {timestamp} ({time_ago})
             )
         )
 
+    # checks that there is enough free space for the `missing` bytes of the
+    # snapshot file (if it's downloaded to a temporary file) and for the node
+    # data the snapshot of the given `size` is expanded to by the import
+    def check_snapshot_free_space(self, size, missing=0):
+        if size is None:
+            logging.info("Snapshot size is unknown, skipping the free space check")
+            return
+        expansion = IMPORT_EXPANSION.get(self.config["history_mode"], 1.0)
+        requirements = {get_data_dir(self.config["network"]): int(size * expansion)}
+        if missing:
+            requirements[TMP_SNAPSHOT_LOCATION] = missing
+        check_free_space(requirements)
+
+    # returns the free space check, rate limit and priority options
+    # of `fetch_snapshot` for the chosen snapshot download mode
+    def snapshot_download_options(self):
+        options = {"preflight": self.check_snapshot_free_space}
+        if self.config["snapshot_download_mode"] != "background":
+            return options
+        rate = parse_rate(self.config["snapshot_download_rate"])
+        print_and_log(
+            f"Downloading the snapshot in the background with the rate limit "
+            f"{format_rate(rate)}, it can be changed by writing a new one "
+            f"to {SNAPSHOT_RATE_CONTROL_FILE}"
+        )
+        return {
+            **options,
+            "limiter": RateLimiter(rate, SNAPSHOT_RATE_CONTROL_FILE),
+            "background": True,
+        }
+
+    # returns the urls of the other providers' snapshots that are identical to
+    # the `name` provider's one, as confirmed by their block hashes and sha256
+    def snapshot_mirrors(self, name):
+        snapshot = self.config["snapshots"][name]
+        if not snapshot.get("sha256") or not snapshot.get("block_hash"):
+            return []
+        mirrors = [
+            other["url"]
+            for title, other in self.config["snapshots"].items()
+            if title != name
+            and other.get("sha256") == snapshot["sha256"]
+            and other.get("block_hash") == snapshot["block_hash"]
+        ]
+        if mirrors:
+            print_and_log(
+                f"The same snapshot is also provided by {len(mirrors)} more "
+                "mirror(s), downloading from all of them"
+            )
+        return mirrors
+
     def fetch_snapshot_from_provider(self, name):
         try:
             url = self.config["snapshots"][name]["url"]
             sha256 = self.config["snapshots"][name]["sha256"]
             self.output_snapshot_metadata(name)
-            return fetch_snapshot(url, sha256)
+            if self.config["snapshot_download_mode"] == "stream":
+                self.import_snapshot_stream(
+                    url,
+                    sha256,
+                    self.config["snapshots"][name]["block_hash"],
+                    self.config["snapshots"][name].get("history_mode") == "full",
+                )
+                return None
+            download_options = self.snapshot_download_options()
+            with self.identity_generation_overlap():
+                snapshot_file, actual_sha256 = fetch_snapshot(
+                    url,
+                    sha256,
+                    self.config["snapshots"][name]["block_hash"],
+                    mirrors=self.snapshot_mirrors(name),
+                    **download_options,
+                )
+            if sha256:
+                print_and_log("Checking the snapshot integrity...")
+                check_sha256(actual_sha256, sha256)
+                print_and_log("Integrity verified.")
+            return snapshot_file
         except KeyError:
             raise InterruptStep
+        except Sha256Mismatch as e:
+            print_and_log("SHA256 mismatch, the snapshot is discarded.", logging.error)
+            print_and_log(f"Expected sha256: {e.expected_sha256}", logging.error)
+            print_and_log(f"Actual sha256: {e.actual_sha256}", logging.error)
+            print()
+            # otherwise the next download of the same snapshot
+            # would be resumed from the corrupted file
+            shutil.rmtree(TMP_SNAPSHOT_LOCATION, ignore_errors=True)
+            os.makedirs(TMP_SNAPSHOT_LOCATION, exist_ok=True)
+            raise InterruptStep
         except (ValueError, urllib.error.URLError):
             logging.error(
                 "The snapshot snapshot download option user have chosen is unavailable"
@@ -561,6 +800,11 @@ block timestamp: {timestamp} ({time_ago})
             print("internet connection or choose another option.")
             print()
             raise InterruptStep
+        except InsufficientSpace as e:
+            print_and_log(str(e), logging.error)
+            print("Please free some disk space or choose another option.")
+            print()
+            raise InterruptStep
 
     def get_snapshot_from_provider(self, provider):
         try:
@@ -571,43 +815,54 @@ block timestamp: {timestamp} ({time_ago})
         snapshot_block_hash = self.config["snapshots"][provider.title]["block_hash"]
         return (snapshot_file, snapshot_block_hash)
 
-    # check if a given provider has the compatible snapshot
-    # available in its metadata and return the metadata of this
-    # snapshot if it's available
-    def try_fallback_provider(self, provider):
-        print(f"Getting snapshots' metadata from {provider.title} instead...")
-        self.get_snapshot_metadata(provider)
-        return self.config["snapshots"].get(provider.title, None)
-
-    # check if some of the providers has the compatible snapshot
-    # available in its metadadata and return the provider name
-    def find_fallback_provider(self, providers):
-        for provider in providers:
-            snapshot = self.try_fallback_provider(provider)
-            if snapshot is not None:
-                return provider
-        return None
+    # collects the snapshots' metadata from all the given providers
+    # at once, so that a slow or dead provider costs no more than
+    # the metadata timeout, and returns the providers that have a compatible
+    # snapshot, the freshest and the fastest to respond first
+    def rank_providers(self, providers):
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=len(providers)) as executor:
+            list(executor.map(self.get_snapshot_metadata, providers))
+
+        available = [p for p in providers if p.title in self.config["snapshots"]]
+        return sorted(
+            available,
+            key=lambda p: (
+                # higher block means fresher snapshot
+                -int(self.config["snapshots"][p.title]["block_height"]),
+                self.config["snapshots"][p.title]["latency"],
+            ),
+        )
 
     # tries to get the latest compatible snapshot from the given
     # provider's metadata
     #
-    # if the snapshot not found, tries to find it in other known
-    # providers
+    # if the snapshot not found, uses the best one among other known
+    # providers, whose metadata is collected at the same time
     def get_snapshot_from_provider_with_fallback(self, provider):
-        print_and_log(f"Getting snapshots' metadata from {provider.title}...")
-
-        self.get_snapshot_metadata(provider)
-        snapshot = self.config["snapshots"].get(provider.title, None)
+        print_and_log("Getting snapshots' metadata from all known providers...")
 
-        if snapshot is None:
-            fallback_providers = default_providers.copy()
-            fallback_providers.remove(provider)
-            fallback_provider = self.find_fallback_provider(fallback_providers)
+        ranking = self.rank_providers(default_providers)
+        for i, ranked in enumerate(ranking):
+            metadata = self.config["snapshots"][ranked.title]
+            logging.info(
+                f"{i + 1}. {ranked.title}: block height {metadata['block_height']}, "
+                f"block timestamp {metadata['block_timestamp']}, "
+                f"latency {metadata['latency']:.2f}s"
+            )
 
-            if fallback_provider is None:
-                return None
-            else:
-                provider = fallback_provider
+        if not ranking:
+            return None
+        elif provider not in ranking:
+            provider = ranking[0]
+            print_and_log(f"Using the snapshot from {provider.title} instead.")
+        elif provider != ranking[0]:
+            best = self.config["snapshots"][ranking[0].title]
+            print_and_log(
+                f"Note: {ranking[0].title} provides a more recent snapshot "
+                f"at block height {best['block_height']}."
+            )
 
         snapshot_file = self.fetch_snapshot_from_provider(provider.title)
         snapshot_block_hash = self.config["snapshots"][provider.title]["block_hash"]
@@ -617,10 +872,17 @@ block timestamp: {timestamp} ({time_ago})
         try:
             self.query_step(snapshot_sha256_query)
             sha256 = self.config["snapshot_sha256"]
-            snapshot_file = fetch_snapshot(url, sha256)
+            if self.config["snapshot_download_mode"] == "stream":
+                self.import_snapshot_stream(url, sha256)
+                return (None, None)
+            download_options = self.snapshot_download_options()
+            with self.identity_generation_overlap():
+                snapshot_file, actual_sha256 = fetch_snapshot(
+                    url, sha256, **download_options
+                )
             if sha256:
                 print_and_log("Checking the snapshot integrity...")
-                check_file_contents_integrity(snapshot_file, sha256)
+                check_sha256(actual_sha256, sha256)
                 print_and_log("Integrity verified.")
             return (snapshot_file, None)
         except (ValueError, urllib.error.URLError):
@@ -630,6 +892,11 @@ block timestamp: {timestamp} ({time_ago})
             print("Please check the URL again or choose another option.")
             print()
             raise InterruptStep
+        except InsufficientSpace as e:
+            print_and_log(str(e), logging.error)
+            print("Please free some disk space or choose another option.")
+            print()
+            raise InterruptStep
         except Sha256Mismatch as e:
             print_and_log("SHA256 mismatch.", logging.error)
             print_and_log(f"Expected sha256: {e.expected_sha256}", logging.error)
@@ -641,6 +908,89 @@ block timestamp: {timestamp} ({time_ago})
                 logging.info("Ignoring hash mismatch")
                 return (snapshot_file, None)
 
+    # Downloads the snapshot straight into 'octez-node snapshot import'
+    # through a named pipe, verifying its sha256 on the way
+    def import_snapshot_stream(self, url, sha256=None, block_hash=None, full=False):
+        import subprocess
+
+        fifo = os.path.join(TMP_SNAPSHOT_LOCATION, "octez_node.snapshot.fifo")
+        try:
+            os.remove(fifo)
+        except FileNotFoundError:
+            pass
+        os.mkfifo(fifo)
+        # the pipe is read by the 'tezos' user
+        os.chmod(fifo, 0o644)
+
+        import_flag = ""
+        if full and self.config["history_mode"] == "archive":
+            import_flag = "--reconstruct "
+        block_hash_option = ""
+        if block_hash is not None:
+            block_hash_option = " --block " + block_hash
+
+        print_and_log(f"Streaming the snapshot from {url}")
+        logging.info("Importing snapshot stream with the octez-node")
+        reader = subprocess.Popen(
+            shlex.split(
+                f"sudo -u tezos octez-node-{self.config['network']} snapshot import "
+                + import_flag
+                + fifo
+                + block_hash_option
+            )
+        )
+        hasher = hashlib.sha256() if sha256 else None
+        verify = (lambda actual: check_sha256(actual, sha256)) if sha256 else None
+
+        # by the time anything fails, the node may have already written a part
+        # of the store, which would make any other import fail as well
+        def abort_import():
+            if reader.poll() is None:
+                reader.terminate()
+            reader.wait()
+            self.remove_blockchain_data()
+
+        try:
+            try:
+                fd = open_fifo_for_writing(fifo, reader)
+                try:
+                    with self.identity_generation_overlap():
+                        stream_file(
+                            url, fd, hasher, verify, self.check_snapshot_free_space
+                        )
+                finally:
+                    os.close(fd)
+            finally:
+                os.remove(fifo)
+            if reader.wait() != 0:
+                raise ChildProcessError(
+                    f"octez-node exited with code {reader.returncode}"
+                )
+        except Sha256Mismatch as e:
+            abort_import()
+            print_and_log(
+                "SHA256 mismatch, the snapshot import is aborted.", logging.error
+            )
+            print_and_log(f"Expected sha256: {e.expected_sha256}", logging.error)
+            print_and_log(f"Actual sha256: {e.actual_sha256}", logging.error)
+            print()
+            raise InterruptStep
+        except (ChildProcessError, BrokenPipeError) as e:
+            abort_import()
+            logging.error(f"octez-node failed to import the snapshot stream: {e}")
+            print("The node has failed to import the snapshot stream.")
+            print("Please check the node logs or try downloading the snapshot")
+            print("to a temporary file instead.")
+            print()
+            raise InterruptStep
+        except BaseException:
+            abort_import()
+            raise
+
+        # the import doesn't need the identity, so it's waited for only now,
+        # after having been generated while the snapshot was being streamed
+        self.wait_for_identity_generation()
+
     def get_snapshot_from_provider_url(self, url):
         provider = XtzShotsLike("custom", url)
         if os.path.basename(provider.metadata_url) == "tezos-snapshots.json":
@@ -652,6 +1002,78 @@ block timestamp: {timestamp} ({time_ago})
                 provider.metadata_url = os.path.join(url, "tezos-snapshots.json")
                 return self.get_snapshot_from_provider(provider)
 
+    # Starts generating the node identity in the background, so that its
+    # proof-of-work is computed while the snapshot is being downloaded
+    # rather than when the node service starts
+    def start_identity_generation(self):
+        node_dir = get_data_dir(self.config["network"])
+        if self.identity_generation is not None or os.path.exists(
+            os.path.join(node_dir, "identity.json")
+        ):
+            return
+        logging.info("Generating the node identity in the background")
+        self.identity_generation = BackgroundCommand(
+            f"sudo -u tezos octez-node-{self.config['network']} identity generate"
+        )
+
+    # Marks the snapshot download, only the time spent on it is reported as
+    # saved by the background identity generation
+    def identity_generation_overlap(self):
+        if self.identity_generation is None:
+            return contextlib.nullcontext()
+        return self.identity_generation.overlapping()
+
+    # Waits for the node identity generation started by
+    # `start_identity_generation` and reports the time it saved
+    def wait_for_identity_generation(self):
+        if self.identity_generation is None:
+            return
+        print_and_log("Waiting for the node identity to be generated...")
+        result, duration, overlapped = self.identity_generation.wait()
+        self.identity_generation = None
+        if result is None or result.returncode != 0:
+            # the node service generates it on start otherwise
+            logging.warning(
+                "Background node identity generation failed: "
+                + ("" if result is None else result.stderr.decode(errors="replace"))
+            )
+            return
+        print_and_log(
+            f"Generated the node identity in {duration:.1f}s, "
+            f"{overlapped:.1f}s of which overlapped with the snapshot download."
+        )
+
+    # Makes the local snapshot file readable for the import by the 'tezos' user
+    # without copying its contents whenever possible: the file is linked or
+    # reflinked into the temporary directory, or used in place if the 'tezos'
+    # user can read it there. Only otherwise it's copied, inside the kernel.
+    def place_snapshot_file(self, path):
+        snapshot_file = os.path.join(
+            TMP_SNAPSHOT_LOCATION, f"file-{time.time()}.snapshot"
+        )
+        if place_file(path, snapshot_file, copy=False) is not None:
+            # a hard link shares the permissions of the original file
+            if readable_by_tezos(snapshot_file):
+                return snapshot_file
+            os.remove(snapshot_file)
+        if readable_by_tezos(path):
+            logging.info(f"Importing {path} in place")
+            return path
+        try:
+            check_free_space({TMP_SNAPSHOT_LOCATION: os.path.getsize(path)})
+        except InsufficientSpace as e:
+            print_and_log(str(e), logging.error)
+            print(f"Please make {path} readable by the 'tezos' user")
+            print("or free some disk space.")
+            print()
+            raise InterruptStep
+        print_and_log(f"Copying {path}, since it isn't readable by the 'tezos' user")
+        if place_file(path, snapshot_file) is None:
+            print_and_log(f"Couldn't copy {path}", logging.error)
+            print()
+            raise InterruptStep
+        return snapshot_file
+
     # Importing the snapshot for Node bootstrapping
     def import_snapshot(self):
         do_import = self.check_blockchain_data()
@@ -670,6 +1092,8 @@ block timestamp: {timestamp} ({time_ago})
 
             os.makedirs(TMP_SNAPSHOT_LOCATION, exist_ok=True)
 
+            self.start_identity_generation()
+
         else:
             return
 
@@ -683,13 +1107,16 @@ block timestamp: {timestamp} ({time_ago})
             try:
                 if self.config["snapshot_mode"] == "skip":
                     return
-                elif self.config["snapshot_mode"] == "file":
+                elif self.config["snapshot_mode"] != "file":
+                    self.query_step(snapshot_download_mode_query)
+                    if self.config["snapshot_download_mode"] == "background":
+                        self.query_step(snapshot_download_rate_query)
+
+                if self.config["snapshot_mode"] == "file":
                     self.query_step(snapshot_file_query)
-                    snapshot_file = os.path.join(
-                        TMP_SNAPSHOT_LOCATION, f"file-{time.time()}.snapshot"
+                    snapshot_file = self.place_snapshot_file(
+                        self.config["snapshot_file"]
                     )
-                    # not copying since it can take a lot of time
-                    os.link(self.config["snapshot_file"], snapshot_file)
                 elif self.config["snapshot_mode"] == "direct url":
                     self.query_step(snapshot_url_query)
                     url = self.config["snapshot_url"]
@@ -728,24 +1155,39 @@ block timestamp: {timestamp} ({time_ago})
 
             valid_choice = True
 
-            import_flag = ""
-            if is_full_snapshot(snapshot_file, self.config["snapshot_mode"]):
-                if self.config["history_mode"] == "archive":
-                    import_flag = "--reconstruct "
-
-            block_hash_option = ""
-            if snapshot_block_hash is not None:
-                block_hash_option = " --block " + snapshot_block_hash
-
-            logging.info("Importing snapshot with the octez-node")
-            proc_call(
-                "sudo -u tezos octez-node-"
-                + self.config["network"]
-                + " snapshot import "
-                + import_flag
-                + snapshot_file
-                + block_hash_option
-            )
+            # streamed snapshots are imported while being downloaded
+            if snapshot_file is not None:
+                import_flag = ""
+                if is_full_snapshot(snapshot_file, self.config["snapshot_mode"]):
+                    if self.config["history_mode"] == "archive":
+                        import_flag = "--reconstruct "
+
+                block_hash_option = ""
+                if snapshot_block_hash is not None:
+                    block_hash_option = " --block " + snapshot_block_hash
+
+                # the background import doesn't compete with the other services
+                # for CPU and disk either
+                priority_prefix = ""
+                if (
+                    self.config["snapshot_mode"] != "file"
+                    and self.config["snapshot_download_mode"] == "background"
+                ):
+                    priority_prefix = background_priority_prefix
+
+                self.wait_for_identity_generation()
+
+                logging.info("Importing snapshot with the octez-node")
+                proc_call(
+                    "sudo -u tezos "
+                    + priority_prefix
+                    + "octez-node-"
+                    + self.config["network"]
+                    + " snapshot import "
+                    + import_flag
+                    + shlex.quote(snapshot_file)
+                    + block_hash_option
+                )
 
             print_and_log("Snapshot imported.")
 
@@ -760,6 +1202,8 @@ block timestamp: {timestamp} ({time_ago})
     def bootstrap_node(self):
 
         self.import_snapshot()
+        # in case the snapshot import was skipped
+        self.wait_for_identity_generation()
 
         logging.info("Starting the node service")
         print(
@@ -767,17 +1211,23 @@ block timestamp: {timestamp} ({time_ago})
             "time, as the node needs a node identity to be generated."
         )
 
-        self.systemctl_simple_action("start", "node")
+        # not waiting for the start job, so that its phases can be reported
+        self.systemctl_simple_action("start --no-block", "node")
 
         print_and_log("Waiting for the node service to start...")
 
-        while True:
-            rpc_endpoint = self.config["node_rpc_endpoint"]
-            try:
-                urllib.request.urlopen(rpc_endpoint + "/version")
-                break
-            except urllib.error.URLError:
-                proc_call("sleep 1")
+        network = self.config["network"]
+        try:
+            wait_for_node(
+                f"tezos-node-{network}.service",
+                self.config["node_rpc_endpoint"],
+                get_data_dir(network),
+            )
+        except NodeNotReady as e:
+            print_and_log(str(e), logging.error)
+            print("Please check the node logs with the following command:")
+            print(f"journalctl -u tezos-node-{network}.service")
+            raise
 
         print_and_log("Generated node identity and started the service.")
 
@@ -797,9 +1247,13 @@ block timestamp: {timestamp} ({time_ago})
 
         print_and_log("Waiting for the node to be bootstrapped...")
 
-        tezos_client_options = self.get_tezos_client_options()
-        proc_call(
-            f"sudo -u tezos {suppress_warning_text} octez-client {tezos_client_options} bootstrapped"
+        wait_for_bootstrap(
+            self.config["node_rpc_endpoint"],
+            {
+                "network": network,
+                "history_mode": self.config["history_mode"],
+                "snapshot_mode": self.config.get("snapshot_mode", "skip"),
+            },
         )
 
         print()
@@ -848,17 +1302,17 @@ block timestamp: {timestamp} ({time_ago})
                     baker_set_up = True
 
     def stake_tez(self):
+        rpc = rpc_client(self.config["node_rpc_endpoint"])
+
         def get_minimal_frozen_stake():
-            output = get_proc_output(
-                f"curl {self.config['node_rpc_endpoint']}/chains/main/blocks/head/context/constants"
-            ).stdout.decode("utf-8")
-            return json.loads(output)["minimal_frozen_stake"]
+            return rpc.get_static("/chains/main/blocks/head/context/constants")[
+                "minimal_frozen_stake"
+            ]
 
         def get_staked_balance(pkh):
-            output = get_proc_output(
-                f"curl {self.config['node_rpc_endpoint']}/chains/main/blocks/head/context/contracts/{pkh}/staked_balance"
-            ).stdout.decode("utf-8")
-            return json.loads(output)
+            return rpc.get(
+                f"/chains/main/blocks/head/context/contracts/{pkh}/staked_balance"
+            )
 
         tezos_client_options = self.get_tezos_client_options()
         baker_alias = self.config["baker_alias"]
@@ -948,17 +1402,37 @@ block timestamp: {timestamp} ({time_ago})
             f"\"{self.config['liquidity_toggle_vote']}\"",
         )
 
+    # The baker is registered once it's its own delegate. That's checked with the
+    # 'contracts/<pkh>/delegate' RPC, whose response doesn't grow with the number of
+    # the contracts delegated to the baker. If the node can't answer it, the list of
+    # the delegated contracts is scanned instead, until the baker is found in it.
     def baker_registered(self):
-        tezos_client_options = self.get_tezos_client_options()
-        baker_alias = self.config["baker_alias"]
-        _, baker_key_hash = get_key_address(tezos_client_options, baker_alias)
+        baker_key_hash = self.config.get("baker_key_hash")
+        if baker_key_hash is None:
+            tezos_client_options = self.get_tezos_client_options()
+            baker_alias = self.config["baker_alias"]
+            _, baker_key_hash = get_key_address(tezos_client_options, baker_alias)
+        rpc = rpc_client(self.config["node_rpc_endpoint"])
         try:
-            output = get_proc_output(
-                f"curl {self.config['node_rpc_endpoint']}/chains/main/blocks/head/context/delegates/{baker_key_hash}"
-            ).stdout.decode("utf-8")
-            response = json.loads(output)
-            return baker_key_hash in response["delegated_contracts"]
-        except:
+            delegate = rpc.get(
+                f"/chains/main/blocks/head/context/contracts/{baker_key_hash}/delegate"
+            )
+            return delegate == baker_key_hash
+        except RpcStatusError as e:
+            # the account doesn't delegate to anyone
+            if e.status == 404:
+                return False
+        except (RpcError, ValueError):
+            return False
+        try:
+            return json_list_contains(
+                rpc.stream_bytes(
+                    f"/chains/main/blocks/head/context/delegates/{baker_key_hash}"
+                ),
+                "delegated_contracts",
+                baker_key_hash,
+            )
+        except RpcError:
             return False
 
     def start_baking(self):
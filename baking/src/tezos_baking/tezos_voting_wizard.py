@@ -49,6 +49,8 @@ parser.add_argument(
 
 parsed_args = parser.parse_args()
 
+ledger_monitor.timeout = parsed_args.ledger_timeout
+
 
 # Wizard CLI utility
 
@@ -77,12 +79,19 @@ def wait_for_ledger_app(app_name, client_dir):
         )
     )
     search_string = b"Found a Tezos " + bytes(app_name, "utf8")
-    output = b""
-    while re.search(search_string, output) is None:
-        output = get_proc_output(
-            f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} list connected ledgers"
-        ).stdout
-        proc_call("sleep 1")
+
+    def list_connected_ledgers():
+        with ledger_lock:
+            output = get_proc_output(
+                f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} list connected ledgers"
+            ).stdout
+        return output if re.search(search_string, output) is not None else None
+
+    if ledger_monitor.wait(list_connected_ledgers) is None:
+        print_and_log(
+            f"The Tezos {app_name} app hasn't been opened in time.", logging.error
+        )
+        raise KeyboardInterrupt
 
 
 # Steps
@@ -301,25 +310,22 @@ class Setup(Setup):
 
     def fill_voting_period_info(self):
         logging.info("Filling in voting period info")
-        logging.info("Getting voting period from octez-client")
-        voting_proc = get_proc_output(
-            f"sudo -u tezos {suppress_warning_text} octez-client "
-            f"{self.config['tezos_client_options']} show voting period"
-        )
-        if voting_proc.returncode == 0:
-            info = voting_proc.stdout
-        else:
+        logging.info("Getting voting period from the node RPC")
+        rpc = rpc_client(self.config["node_rpc_endpoint"])
+        try:
+            period = rpc.get("/chains/main/blocks/head/votes/current_period")
+            self.config["amendment_phase"] = period["voting_period"]["kind"]
+            if self.config["amendment_phase"] == "proposal":
+                proposals = rpc.get("/chains/main/blocks/head/votes/proposals")
+                self.config["proposal_hashes"] = [phash for phash, _ in proposals]
+            else:
+                proposal = rpc.get("/chains/main/blocks/head/votes/current_proposal")
+                self.config["proposal_hashes"] = [] if proposal is None else [proposal]
+        except (RpcError, ValueError, KeyError):
             print_and_log("Couldn't get the voting period info.", logging.error)
             print("Please check that the network for voting has been set up correctly.")
             raise KeyboardInterrupt
 
-        self.config["amendment_phase"] = (
-            re.search(b'Current period: "(\\w+)"', info).group(1).decode("utf-8")
-        )
-        self.config["proposal_hashes"] = [
-            phash.decode() for phash in re.findall(protocol_hash_regex, info)
-        ]
-
     def process_proposal_period(self):
         logging.info("Processing proposal period")
         self.query_step(get_proposal_period_hash(self.config["proposal_hashes"]))
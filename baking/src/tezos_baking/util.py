@@ -10,6 +10,10 @@ import re
 import urllib.request
 import json
 import os
+import stat
+import time
+import threading
+import contextlib
 
 # Regexes
 
@@ -27,8 +31,40 @@ derivation_path_regex = b"(?:bip25519|ed25519|secp256k1|P-256)\\/[0-9]+h\\/[0-9]
 
 http_request_headers = {"User-Agent": "Mozilla/5.0"}
 
+# Timeout in seconds for checking whether a URL is reachable
+URL_CHECK_TIMEOUT = 10
+
 suppress_warning_text = "TEZOS_CLIENT_UNSAFE_DISABLE_DISCLAIMER=YES"
 
+# Directory for the caches shared by the wizard runs, it's only writable by
+# root, unlike e.g. /var/tmp, where another user could create it first
+CACHE_DIR = "/var/cache/tezos-setup/"
+
+
+# Creates `directory` if needed and checks that it and its parents can't be
+# changed by the other users, so that they can't plant files or symlinks
+# in it to be read or overwritten by the wizard, which usually runs as root.
+# Raises `PermissionError` otherwise.
+def ensure_private_dir(directory):
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+    uid = os.geteuid()
+    path = os.path.abspath(directory)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or st.st_mode & 0o022:
+        raise PermissionError(
+            f"{path} has to be a directory owned by the current user "
+            "and not writable by the others"
+        )
+    while path != os.path.dirname(path):
+        path = os.path.dirname(path)
+        st = os.lstat(path)
+        # the entries of the sticky directories, e.g. /tmp, can only be
+        # renamed or removed by their owners
+        if st.st_uid not in [0, uid] or (
+            st.st_mode & 0o022 and not st.st_mode & stat.S_ISVTX
+        ):
+            raise PermissionError(f"{path} can be changed by the other users")
+
 
 def proc_call(cmd):
     return subprocess.check_call(shlex.split(cmd))
@@ -41,50 +77,174 @@ def get_proc_output(cmd):
         return subprocess.run(shlex.split(cmd), capture_output=True)
 
 
-def show_systemd_service(service_name):
-    return get_proc_output(f"systemctl show {service_name}.service").stdout
-
-
-def find_systemd_env_files(show_systemd_output):
-    return re.findall(b"EnvironmentFiles?=(.*) ", show_systemd_output)
-
-
-def find_systemd_unit_env(show_systemd_output):
-    unit_env = re.search(b"Environment=(.*)(?:$|\n)", show_systemd_output)
-    if unit_env is not None:
-        return unit_env.group(1).decode("utf-8")
-    return ""
-
-
-# Returns all the environment variables of a systemd service unit
-# Note: definitions directly in the unit (not in environment files) take precedence
-def get_systemd_service_env(service_name):
-    result = dict()
-    sys_show = show_systemd_service(service_name)
-
-    for env_file in find_systemd_env_files(sys_show):
-        with open(env_file, "r") as f:
+class BackgroundCommand:
+    """
+    Runs a command in a separate thread, so that it overlaps with the other work,
+    and keeps track of how much of its run time was overlapped by the work
+    marked with `overlapping`.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.result = None
+        self.started = time.monotonic()
+        self.finished = None
+        # (start, end) of the work marked with `overlapping`
+        self.overlaps = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.result = get_proc_output(self.cmd)
+        finally:
+            self.finished = time.monotonic()
+
+    # Marks the work that is run meanwhile as the one the command overlaps with,
+    # the rest of the time, e.g. waiting for the user's answers, doesn't count
+    @contextlib.contextmanager
+    def overlapping(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.overlaps.append((start, time.monotonic()))
+
+    # Waits for the command to finish, returns its result (None if it couldn't
+    # be run), the total run time and the part of it that was overlapped
+    def wait(self):
+        self.thread.join()
+        overlapped = sum(
+            max(0, min(end, self.finished) - max(start, self.started))
+            for start, end in self.overlaps
+        )
+        return (self.result, self.finished - self.started, overlapped)
+
+
+# Splits the `systemctl show` output for several units, which are separated
+# by the empty lines, into the {unit id: {property: [values]}} dict
+def parse_systemctl_show(output):
+    units = {}
+    properties = {}
+    for line in output.splitlines() + [""]:
+        if line:
+            key, _, value = line.partition("=")
+            properties.setdefault(key, []).append(value)
+        elif properties:
+            if "Id" in properties:
+                units[properties["Id"][0]] = properties
+            properties = {}
+    return units
+
+
+class SystemdEnvResolver:
+    """
+    Environment of the systemd units. The properties of all the loaded units
+    matching `pattern` are read with a single `systemctl show`, and
+    the environment files are only parsed again once they have changed.
+    """
+
+    properties = ["Id", "Environment", "EnvironmentFiles"]
+
+    def __init__(self, pattern="tezos-*"):
+        self.pattern = pattern
+        # unit id -> {property: [values]}
+        self.units = {}
+        # path -> ((mtime, size, inode), {variable: value})
+        self.env_files = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def unit_id(unit):
+        return unit if "." in unit else unit + ".service"
+
+    # Reads the properties of the `units` that haven't been read yet, along with
+    # those of all the loaded units matching the pattern, in one call
+    def prefetch(self, *units):
+        with self.lock:
+            missing = [
+                self.unit_id(unit)
+                for unit in units
+                if self.unit_id(unit) not in self.units
+            ]
+        if units and not missing:
+            return
+        output = get_proc_output(
+            f"systemctl show --property={','.join(self.properties)} "
+            + " ".join(shlex.quote(unit) for unit in missing + [self.pattern])
+        ).stdout.decode("utf-8")
+        loaded = parse_systemctl_show(output)
+        with self.lock:
+            self.units.update(loaded)
+            for unit in missing:
+                self.units.setdefault(unit, {})
+
+    def get_properties(self, unit):
+        unit = self.unit_id(unit)
+        self.prefetch(unit)
+        with self.lock:
+            return self.units[unit]
+
+    # Returns the paths of the environment files of the unit, as bytes,
+    # skipping the missing optional ones
+    def get_env_files(self, unit):
+        env_files = []
+        for value in self.get_properties(unit).get("EnvironmentFiles", []):
+            # e.g. '/etc/default/tezos-node-mainnet (ignore_errors=no)'
+            path, _, flags = value.rpartition(" (")
+            if not path:
+                path = value
+            if "ignore_errors=yes" in flags and not os.path.exists(path):
+                continue
+            env_files.append(path.encode("utf-8"))
+        return env_files
+
+    def read_env_file(self, path):
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            cached = self.env_files.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        result = dict()
+        with open(path, "r") as f:
             for line in f:
                 env_def = re.search("^(\\w+)=(.*)\n", line)
                 if env_def is not None:
                     env_var = env_def.group(1)
                     var_val = env_def.group(2).strip('"')
                     result[env_var] = var_val
+        with self.lock:
+            self.env_files[path] = (stamp, result)
+        return result
+
+    # Returns all the environment variables of a systemd service unit
+    # Note: definitions directly in the unit (not in environment files) take precedence
+    def get_env(self, unit):
+        result = dict()
+        for env_file in self.get_env_files(unit):
+            result.update(self.read_env_file(env_file))
+
+        unit_env = self.get_properties(unit).get("Environment", [""])[0]
+        env_matches = re.findall(r'(\w+)=(("(?:\\.|[^"\\])*")|([\S]+))', unit_env)
+        for env_match in env_matches:
+            env_var = env_match[0]
+            var_val = env_match[1].strip('"')
+            result[env_var] = var_val
+
+        return result
 
-    env_matches = re.findall(
-        r'(\w+)=(("(?:\\.|[^"\\])*")|([\S]+))',
-        find_systemd_unit_env(sys_show),
-    )
-    for env_match in env_matches:
-        env_var = env_match[0]
-        var_val = env_match[1].strip('"')
-        result[env_var] = var_val
 
-    return result
+systemd_env = SystemdEnvResolver()
+
+
+# Returns all the environment variables of a systemd service unit
+def get_systemd_service_env(service_name):
+    return systemd_env.get_env(service_name)
 
 
 def replace_systemd_service_env(service_name, field, value):
-    for env_file in find_systemd_env_files(show_systemd_service(service_name)):
+    for env_file in systemd_env.get_env_files(service_name):
         with open(env_file, "r") as f:
             config_contents = f.read()
 
@@ -141,10 +301,12 @@ def mk_full_url(host_name, path):
     return url
 
 
-def url_is_reachable(url):
+# Only the response status is waited for, the body is never read, so that
+# checking e.g. a snapshot URL doesn't download the snapshot
+def url_is_reachable(url, timeout=URL_CHECK_TIMEOUT):
     req = urllib.request.Request(url, headers=http_request_headers)
     try:
-        urllib.request.urlopen(req)
-        return True
-    except (urllib.error.URLError, ValueError):
+        with urllib.request.urlopen(req, timeout=timeout):
+            return True
+    except (OSError, ValueError):
         return False
@@ -75,6 +75,18 @@ def tez_bigger_than(min):
     return _validator
 
 
+def download_rate(input):
+    from .snapshot import parse_rate
+
+    try:
+        parse_rate(input)
+    except ValueError:
+        raise ValueError(
+            "Please input a number of bytes per second, at least 1, with an optional K, M or G suffix."
+        )
+    return input
+
+
 # The input has to be valid to at least one of the two passed validators.
 def any_of(validator1, validator2):
     def _validator(input):
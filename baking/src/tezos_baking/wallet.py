@@ -0,0 +1,62 @@
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+"""
+Read-only access to the keys stored in the octez-client base dir
+"""
+
+import os
+import json
+import shlex
+import threading
+
+
+class WalletCache:
+    """
+    Aliases of the octez-client wallet files, e.g. 'public_key_hashs',
+    every file is only read again once it has changed
+    """
+
+    def __init__(self):
+        # path -> ((mtime, size, inode), {alias: value})
+        self.files = {}
+        self.lock = threading.Lock()
+
+    # Returns the {alias: value} dict of the wallet file, which is empty
+    # if the file doesn't exist yet.
+    # Raises `OSError` or `ValueError` if it can't be read or parsed.
+    def read(self, base_dir, filename):
+        path = os.path.join(base_dir, filename)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return {}
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            cached = self.files.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, "r") as f:
+            aliases = {entry["name"]: entry["value"] for entry in json.load(f)}
+        with self.lock:
+            self.files[path] = (stamp, aliases)
+        return aliases
+
+    def public_key_hash(self, base_dir, alias):
+        return self.read(base_dir, "public_key_hashs").get(alias)
+
+    # Returns the secret key URI, e.g. 'encrypted:edesk...' or 'ledger://...'
+    def secret_key(self, base_dir, alias):
+        return self.read(base_dir, "secret_keys").get(alias)
+
+
+wallet_cache = WalletCache()
+
+
+# Returns the base dir passed with the `tezos_client_options`, if any
+def get_client_base_dir(tezos_client_options):
+    args = shlex.split(tezos_client_options)
+    for i, arg in enumerate(args[:-1]):
+        if arg in ["--base-dir", "-d"]:
+            return args[i + 1]
+    return None
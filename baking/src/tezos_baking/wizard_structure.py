@@ -17,6 +17,10 @@ import urllib.request
 import json
 
 from tezos_baking.util import *
+from tezos_baking.rpc import *
+from tezos_baking.ledger import *
+from tezos_baking.node_monitor import *
+from tezos_baking.wallet import *
 from tezos_baking.validators import Validator
 import tezos_baking.validators as validators
 from tezos_baking.steps import *
@@ -25,6 +29,15 @@ from tezos_baking.steps import *
 
 parser = argparse.ArgumentParser()
 
+parser.add_argument(
+    "--ledger-timeout",
+    required=False,
+    type=float,
+    default=None,
+    help="Number of seconds to wait for the Tezos app to be opened on the Ledger device. "
+    "Waits indefinitely by default.",
+)
+
 # Wizard CLI skeleton
 
 
@@ -40,39 +53,71 @@ def get_data_dir(network):
     return data_dir
 
 
+key_value_regex = (
+    b"(?:"
+    + ledger_regex
+    + b")|(?:"
+    + secret_key_regex
+    + b")|(?:remote\\:"
+    + address_regex
+    + b")"
+)
+
+
+# The key is looked up in the wallet files of the client base dir first,
+# octez-client is only called if they can't be read or the key is stored
+# in an unexpected way
 def get_key_address(tezos_client_options, key_alias):
     logging.info("Getting the secret key address")
+    base_dir = get_client_base_dir(tezos_client_options)
+    if base_dir is not None:
+        try:
+            address = wallet_cache.public_key_hash(base_dir, key_alias)
+            value = wallet_cache.secret_key(base_dir, key_alias)
+            if address is None and value is None:
+                return None
+            if (
+                address is not None
+                and isinstance(value, str)
+                and re.fullmatch(key_value_regex, value.encode()) is not None
+            ):
+                return (value, address)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.info(f"Couldn't read the wallet in {base_dir}: {e}")
     address = get_proc_output(
         f"sudo -u tezos {suppress_warning_text} octez-client {tezos_client_options} "
         f"show address {key_alias} --show-secret"
     )
     if address.returncode == 0:
-        value_regex = (
-            b"(?:"
-            + ledger_regex
-            + b")|(?:"
-            + secret_key_regex
-            + b")|(?:remote\\:"
-            + address_regex
-            + b")"
-        )
-        value = re.search(value_regex, address.stdout).group(0).decode()
+        value = re.search(key_value_regex, address.stdout).group(0).decode()
         address = re.search(address_regex, address.stdout).group(0).decode()
         return (value, address)
     else:
         return None
 
 
+# The connected ledgers are only listed with octez-client when a Ledger device
+# is connected or reconnects, e.g. because an app has been opened on it
 def wait_for_ledger_app(ledger_app, client_dir):
-    output = b""
-    try:
-        while re.search(f"Found a Tezos {ledger_app}".encode(), output) is None:
+    def list_connected_ledgers():
+        with ledger_lock:
             output = get_proc_output(
                 f"sudo -u tezos {suppress_warning_text} octez-client --base-dir {client_dir} list connected ledgers"
             ).stdout
-            proc_call("sleep 1")
+        if re.search(f"Found a Tezos {ledger_app}".encode(), output) is None:
+            return None
+        return output
+
+    try:
+        output = ledger_monitor.wait(list_connected_ledgers)
     except KeyboardInterrupt:
         return None
+    if output is None:
+        print()
+        print_and_log(
+            f"The Tezos {ledger_app} app hasn't been opened in time.", logging.error
+        )
+        return None
     ledgers_derivations = {}
     for ledger_derivation in re.findall(ledger_regex, output):
         ledger_url = (
@@ -212,6 +257,8 @@ class Setup:
     def fill_baking_config(self):
         logging.info("Filling in baking config...")
         net = self.config["network"]
+        # the node environment is needed soon after, so both units are read at once
+        systemd_env.prefetch(f"tezos-baking-{net}", f"tezos-node-{net}")
         baking_env = get_systemd_service_env(f"tezos-baking-{net}")
 
         self.config["client_data_dir"] = baking_env.get(
@@ -237,10 +284,10 @@ class Setup:
         self.config["remote_key"] = rsu.group(2)
 
     def get_current_head_level(self):
-        response = urllib.request.urlopen(
-            self.config["node_rpc_endpoint"] + "/chains/main/blocks/head/header"
+        header = rpc_client(self.config["node_rpc_endpoint"]).get(
+            "/chains/main/blocks/head/header"
         )
-        return str(json.load(response)["level"])
+        return str(header["level"])
 
     # Check whether the baker_alias account is set up to use ledger
     def check_ledger_use(self, key=None):
@@ -312,7 +359,20 @@ class Setup:
                         f"Waiting for funds to arrive... (Ctrl + C to choose another option)."
                     )
                     try:
+                        _, address = get_key_address(tezos_client_options, baker_alias)
+                        # once the funds have arrived, the registration is retried
+                        # on every new block, whatever the reason of the failure,
+                        # e.g. the fees not being covered or the node still syncing
+                        level = None
                         while True:
+                            balance, level = wait_for_funds(
+                                self.config["node_rpc_endpoint"],
+                                address,
+                                after_level=level,
+                            )
+                            print_and_log(
+                                f"The balance is {balance / 10**6} tez as of level {level}."
+                            )
                             result = get_proc_output(
                                 f"sudo -u tezos {suppress_warning_text} octez-client {tezos_client_options} "
                                 f"register key {baker_alias} as delegate"
@@ -320,8 +380,12 @@ class Setup:
                             if result.returncode == 0:
                                 print(result.stdout.decode("utf8"))
                                 break
-                            else:
-                                proc_call("sleep 1")
+                            print_and_log(
+                                "Couldn't register the baker:\n"
+                                + result.stderr.decode("utf8", errors="replace"),
+                                logging.warning,
+                            )
+                            print("Retrying on the next block...")
                     except KeyboardInterrupt:
                         logging.error("Got keyboard interrupt")
                         print("Going back to the import mode selection.")
@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+# Measures the snapshot download throughput of the setup wizard depending on
+# the number of connections. The snapshot is served by a local HTTP server that
+# supports Range requests and limits the rate of every connection, the way the
+# snapshot providers' servers do.
+# Is run from the repository root, e.g.
+#   ./scripts/benchmark-snapshot-download.py --size 512 --rate 16 --connections 1,2,4,8
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import http.server
+
+sys.path.append("baking/src")
+from tezos_baking.snapshot import download_snapshot
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size", type=int, default=512, help="Snapshot size in MiB")
+parser.add_argument(
+    "--rate", type=float, default=16, help="Rate limit of a connection in MiB/s"
+)
+parser.add_argument(
+    "--connections",
+    default="1,2,4,8",
+    help="Comma-separated numbers of connections to measure",
+)
+args = parser.parse_args()
+
+BLOCK_SIZE = 64 * 1024
+# the contents don't matter, only their size does
+block = os.urandom(BLOCK_SIZE)
+size = args.size * 1024 * 1024
+rate = args.rate * 1024 * 1024
+
+
+class ThrottledRangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise the small writes of the headers are delayed by Nagle's algorithm
+    wbufsize = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header is not None:
+            first, _, last = header[len("bytes=") :].partition("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", '"benchmark"')
+        self.end_headers()
+
+        started = time.monotonic()
+        sent = 0
+        remaining = end - start + 1
+        try:
+            while remaining > 0:
+                count = min(BLOCK_SIZE - (start + sent) % BLOCK_SIZE, remaining)
+                offset = (start + sent) % BLOCK_SIZE
+                self.wfile.write(block[offset : offset + count])
+                sent += count
+                remaining -= count
+                delay = sent / rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ThrottledRangeHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = f"http://127.0.0.1:{server.server_address[1]}/octez_node.snapshot"
+
+print(f"{args.size} MiB snapshot, {args.rate} MiB/s per connection")
+print(f"{'connections':>11} {'seconds':>8} {'MiB/s':>8}")
+directory = tempfile.mkdtemp()
+try:
+    for connections in map(int, args.connections.split(",")):
+        filename = os.path.join(directory, "octez_node.snapshot")
+        state_file = os.path.join(directory, "octez_node.snapshot.ranges")
+        for path in [filename, state_file]:
+            if os.path.exists(path):
+                os.remove(path)
+        # the progress is printed to stdout by the download itself
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            started = time.monotonic()
+            download_snapshot(url, filename, state_file, connections=connections)
+            elapsed = time.monotonic() - started
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        assert os.path.getsize(filename) == size
+        print(f"{connections:>11} {elapsed:>8.1f} {size / elapsed / 1024**2:>8.1f}")
+finally:
+    shutil.rmtree(directory)
+    server.shutdown()
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+# SPDX-FileCopyrightText: 2024 Oxhead Alpha
+# SPDX-License-Identifier: LicenseRef-MIT-OA
+
+# Measures how long it takes to pick the Marigold snapshot out of the metadata
+# with lots of synthetic artifacts, for several versions of the local node.
+# With `--baseline`, the selection from `provider.py` of the given git revision
+# is measured as well, along with the sort its `get_snapshot_metadata` did,
+# and both selections are checked to pick the same snapshot.
+# Is run from the repository root, e.g.
+#   ./scripts/benchmark-snapshot-selection.py --artifacts 100000 --baseline <revision>
+
+import sys
+import time
+import types
+import random
+import argparse
+import subprocess
+
+sys.path.append("baking/src")
+import tezos_baking.provider as provider
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--artifacts", type=int, default=100000)
+parser.add_argument(
+    "--baseline",
+    help="Git revision whose snapshot selection is compared with the current one",
+)
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+networks = ["mainnet", "ghostnet", "parisnet"]
+history_modes = ["rolling", "full", "archive"]
+node_versions = {
+    "21.2 (exact hit)": (21, 2, None),
+    "21.5~rc2": (21, 5, 2),
+    "23.0 (no exact)": (23, 0, None),
+}
+
+
+def synthetic_artifact(rng, block_height):
+    rc = rng.choice([None, None, None, 1, 2, 3])
+    return {
+        "artifact_type": rng.choice(["tezos-snapshot"] * 9 + ["tarball"]),
+        "chain_name": rng.choice(networks),
+        "history_mode": rng.choice(history_modes),
+        "block_height": block_height,
+        "snapshot_version": rng.choice([None, 4, 5, 6, 7]),
+        "tezos_version": {
+            "version": {
+                "major": rng.randint(18, 22),
+                "minor": rng.randint(0, 5),
+                "additional_info": "release" if rc is None else {"rc": rc},
+            }
+        },
+    }
+
+
+def load_baseline(revision):
+    source = subprocess.run(
+        ["git", "show", f"{revision}:baking/src/tezos_baking/provider.py"],
+        capture_output=True,
+        check=True,
+    ).stdout
+    module = types.ModuleType("baseline_provider")
+    exec(compile(source, "baseline_provider.py", "exec"), module.__dict__)
+    return module
+
+
+# Best time in milliseconds of `repeat` calls of `select`
+def measure(select, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = select()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+rng = random.Random(args.seed)
+heights = rng.sample(range(args.artifacts * 10), args.artifacts)
+snapshot_array = [synthetic_artifact(rng, height) for height in heights]
+baseline = None if args.baseline is None else load_baseline(args.baseline)
+
+print(f"{args.artifacts} artifacts, mainnet rolling, best of {args.repeat}")
+header = f"{'node version':<18} {'current':>9}"
+if baseline is not None:
+    header += f" {'baseline':>9}   same snapshot"
+print(header)
+for title, version in node_versions.items():
+    provider.get_node_version = lambda: version
+    current = provider.Marigold("marigold.dev", None)
+    elapsed, selected = measure(
+        lambda: current.extract_relevant_snapshot(snapshot_array, "mainnet", "rolling"),
+        args.repeat,
+    )
+    line = f"{title:<18} {elapsed:>7.1f}ms"
+    if baseline is not None:
+        baseline.get_node_version = lambda: version
+        old = baseline.Marigold("marigold.dev", None)
+
+        def select_baseline():
+            snapshots = sorted(
+                snapshot_array, reverse=True, key=lambda x: x["block_height"]
+            )
+            return old.extract_relevant_snapshot(snapshots, "mainnet", "rolling")
+
+        baseline_elapsed, baseline_selected = measure(select_baseline, args.repeat)
+        line += f" {baseline_elapsed:>7.1f}ms   {baseline_selected == selected}"
+    print(line)
@@ -8,6 +8,7 @@ from typing import List
 
 from tezos_baking.wizard_structure import (
     get_key_address,
+    get_systemd_service_env,
     proc_call,
     replace_systemd_service_env,
     url_is_reachable,
@@ -176,6 +177,7 @@ def test_nondefault_node_rpc_endpoint():
     rpc_addr = "127.0.0.1:8735"
     replace_systemd_service_env("tezos-node-quebecnet", "NODE_RPC_ADDR", rpc_addr)
     proc_call("cat /etc/default/tezos-node-quebecnet")
+    assert get_systemd_service_env("tezos-node-quebecnet")["NODE_RPC_ADDR"] == rpc_addr
     try:
         node_service_test("quebecnet", f"http://{rpc_addr}")
     finally: